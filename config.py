@@ -6,11 +6,69 @@
 # https://github.com/mozilla/mozmill-ci/blob/master/jenkins-master/jobs/scripts/workspace/config.py
 
 import os
+import re
 
 here = os.path.dirname(os.path.abspath(__file__))
 
 config = {
     'version': '1.0.0',
+    'http': {
+        'pool_size': 10,
+        'connect_timeout': 10,
+        'read_timeout': 120
+    },
+    'throttle': {
+        'rate': 5,
+        'burst': 10,
+        'max_attempts': 5,
+        'backoff_base': 1,
+        'backoff_max': 60,
+        'failure_threshold': 5,
+        'reset_timeout': 60
+    },
+    'spool': {
+        'concurrency': 4,
+        'max_attempts': 10,
+        'retry_delay': 30,
+        'poll_interval': 5
+    },
+    'backfill': {
+        'key_pattern': r'^(?P<test_type>[^/]+)/(?P<device>[^/]+)/(?P<memory>\d+)/'
+                       r'(?P<revision>[0-9a-f]{12,40})/(?P<start_time>\d+)/(?P<app_name>[^/]+)\.log$',
+        'workers': 4,
+        'batch_size': 200
+    },
+    'revision_hash_cache': {
+        'path': os.path.join(here, '../revision-hash-cache'),
+        'ttl': 86400,
+        'max_entries': 256
+    },
+    'history': {
+        'path': os.path.join(here, '../raptor-history')
+    },
+    'dynamic_thresholds': {
+        # computed from the passing runs, and never above the thresholds of the test types
+        'enabled': False,
+        'path': os.path.join(here, '../raptor-thresholds.json'),
+        'window': 30,
+        'min_runs': 10,
+        'mad_factor': 3
+    },
+    'regressions': {
+        # needs numpy, runs are looked at once both sides of a shift have min_segment runs
+        'enabled': True,
+        'window': 60,
+        'min_segment': 5,
+        't_threshold': 5,
+        'min_change': 0.05
+    },
+    'reports': {
+        # charts of the last `days` days of every series, downsampled to `points` points
+        'enabled': True,
+        'path': os.path.join(here, '../raptor-reports'),
+        'points': 200,
+        'days': 90
+    },
     'test_types': {
         'cold-launch': {
             'treeherder': {
@@ -120,6 +178,16 @@ config = {
                 'test-startup-limit': 13,
                 'video': 12
             },
+            'metrics': [
+                'navigationLoaded',
+                'navigationInteractive',
+                'visuallyLoaded',
+                'contentInteractive',
+                'fullyLoaded',
+                'uss',
+                'pss',
+                'rss'
+            ],
         },
         'reboot': {
             'treeherder': {
@@ -149,6 +217,21 @@ config = {
             'panel-ids': {
                 'homescreen': 18
             },
+            'metrics': [
+                'deviceReboot',
+                'osLogoEnd',
+                'visuallyLoaded',
+                'contentInteractive',
+                'fullyLoaded',
+                'uss',
+                'pss',
+                'rss'
+            ],
         },
     },
 }
+
+# Compile the summary table row pattern for the metrics of each test type
+for settings in config['test_types'].values():
+    settings['metrics_re'] = re.compile(r'^\| (%s) +\| ' % '|'.join(
+        re.escape(metric) for metric in settings['metrics']))
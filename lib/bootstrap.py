@@ -0,0 +1,33 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import random
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def bootstrap_bound(samples, iterations, confidence=0.95, seed=0):
+    """Return the upper bound of the confidence interval of the mean of `samples`.
+
+    The samples are resampled with replacement `iterations` times, and the
+    bound is the matching percentile of the means of the resamples. All
+    resamples are drawn at once with numpy if it is installed. The fixed
+    `seed` makes the same samples always give the same bound.
+
+    """
+    percentile = (1 + confidence) / 2.0
+
+    if numpy is not None:
+        values = numpy.asarray(samples, dtype=float)
+        indices = numpy.random.RandomState(seed).randint(0, len(values),
+                                                         size=(iterations, len(values)))
+        return float(numpy.percentile(values[indices].mean(axis=1), percentile * 100))
+
+    generator = random.Random(seed)
+    means = sorted(sum(generator.choice(samples) for _ in samples) / float(len(samples))
+                   for _ in range(iterations))
+    return means[min(len(means) - 1, int(percentile * len(means)))]
@@ -0,0 +1,94 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import hashlib
+import json
+import os
+import time
+
+from utils import TEMP_PREFIX, atomic_write
+
+
+class RevisionHashCache(object):
+    """On-disk cache of Treeherder revision hashes with a time to live.
+
+    Every entry is stored in its own file, which is written to a temporary file
+    first and then renamed into place. That way several processes on the same
+    node can share the cache without locking, and never see partial entries.
+
+    """
+
+    def __init__(self, path, ttl, max_entries):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        self.hits = 0
+        self.misses = 0
+
+    def _entry_path(self, url, repository, revision):
+        key = '\n'.join([url, repository, revision])
+        return os.path.join(self.path, hashlib.sha1(key).hexdigest())
+
+    def get(self, url, repository, revision):
+        """Return the cached revision hash, or None if missing or expired."""
+        entry = self._entry_path(url, repository, revision)
+        try:
+            if time.time() - os.path.getmtime(entry) < self.ttl:
+                with open(entry, 'r') as f:
+                    revision_hash = json.load(f)['revision_hash']
+                self.hits += 1
+                return revision_hash
+        except (IOError, OSError, KeyError, ValueError):
+            pass
+
+        self.misses += 1
+        return None
+
+    def set(self, url, repository, revision, revision_hash):
+        """Store the revision hash and evict expired or surplus entries."""
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                # another process may have created it in the meantime
+                if not os.path.isdir(self.path):
+                    raise
+
+        try:
+            atomic_write(self._entry_path(url, repository, revision),
+                         json.dumps({'url': url,
+                                     'repository': repository,
+                                     'revision': revision,
+                                     'revision_hash': revision_hash}))
+        except (IOError, OSError) as e:
+            # the cache only saves requests, the revision hash is looked up again next time
+            print('Failed to cache the revision hash: %s' % e)
+            return
+
+        self.evict()
+
+    def evict(self):
+        """Remove expired entries, and the oldest ones beyond `max_entries`."""
+        now = time.time()
+        entries = []
+
+        for name in os.listdir(self.path):
+            entry = os.path.join(self.path, name)
+            try:
+                mtime = os.path.getmtime(entry)
+                if now - mtime >= self.ttl:
+                    os.remove(entry)
+                elif not name.startswith(TEMP_PREFIX):
+                    entries.append((mtime, entry))
+            except OSError:
+                # already removed by another process
+                pass
+
+        entries.sort(reverse=True)
+        for _, entry in entries[self.max_entries:]:
+            try:
+                os.remove(entry)
+            except OSError:
+                pass
@@ -0,0 +1,348 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import argparse
+import hashlib
+import json
+import os
+import struct
+import sys
+import time
+
+from utils import atomic_write
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+INDEX_FILE = 'index.json'
+LOCK_FILE = '.lock'
+
+# Value columns stored for every metric, in the order of the Raptor summary table
+COLUMNS = ('mean', 'median', 'min', 'max', 'stddev', 'bound_95')
+# Every record starts with the epoch of the run, the (padded) revision and the job status
+RECORD_HEADER = '<q40s10s'
+HEADER_FIELDS = 3
+TIMESTAMP = struct.Struct('<q')
+NAN = float('nan')
+
+
+def series_key(test_type, device, memory, app):
+    return '/'.join([test_type, device, str(memory), app])
+
+
+class ResultHistory(object):
+    """Append-only local store of the parsed results of Raptor runs.
+
+    Every series, i.e. the runs of a (test type, device, memory, app), is kept
+    in its own file of fixed size records sorted by the time of the run. A
+    record holds the timestamp, the revision, the status of the job and all
+    value columns of the metrics the series was created with, with NaN for
+    missing values.
+
+    `index.json` maps the series to their files and metrics. Looking up a
+    series is a dictionary lookup, and a time range of it is found with a
+    binary search over the timestamps, followed by a single contiguous read.
+
+    Writes are serialized with a lock file, and files are only ever replaced
+    by renaming, so readers never see partial records and need no locking.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._index = None
+        self._index_mtime = None
+
+    @property
+    def index(self):
+        index_path = os.path.join(self.path, INDEX_FILE)
+        try:
+            mtime = os.path.getmtime(index_path)
+        except OSError:
+            return {}
+
+        if mtime != self._index_mtime:
+            with open(index_path, 'r') as f:
+                self._index = json.load(f)
+            self._index_mtime = mtime
+        return self._index
+
+    def _lock(self):
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                # another process may have created it in the meantime
+                if not os.path.isdir(self.path):
+                    raise
+
+        f = open(os.path.join(self.path, LOCK_FILE), 'a')
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        return f
+
+    def _replace(self, name, data):
+        atomic_write(os.path.join(self.path, name), data)
+
+    def _record_struct(self, series):
+        return struct.Struct(RECORD_HEADER + '%dd' % (len(series['metrics']) * len(COLUMNS)))
+
+    def _bisect(self, f, count, size, timestamp, right=False):
+        """Return the position of the first record at or (if `right`) after `timestamp`."""
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            f.seek(mid * size)
+            value = TIMESTAMP.unpack(f.read(TIMESTAMP.size))[0]
+            if value < timestamp or (right and value == timestamp):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def series(self, test_type=None, device=None, memory=None, app=None):
+        """Return the (test type, device, memory, app) of all series matching the filters."""
+        filters = (test_type, device, None if memory is None else str(memory), app)
+        result = []
+        for key in sorted(self.index):
+            parts = tuple(key.split('/'))
+            if all(value is None or value == part for value, part in zip(filters, parts)):
+                result.append(parts)
+        return result
+
+    def metrics(self, test_type, device, memory, app):
+        series = self.index.get(series_key(test_type, device, memory, app))
+        return list(series['metrics']) if series else []
+
+    def count(self, test_type, device, memory, app):
+        series = self.index.get(series_key(test_type, device, memory, app))
+        if not series:
+            return 0
+
+        try:
+            size = os.path.getsize(os.path.join(self.path, series['file']))
+        except OSError:
+            return 0
+        return size // self._record_struct(series).size
+
+    def append(self, test_type, device, memory, app, timestamp, revision, metrics, names=None,
+               status=None):
+        """Store the metrics of a run, in the format of `RaptorResultParser.metrics`.
+
+        A new series stores the metrics given by `names`, or those of the run.
+        `status` is the result of the job, e.g. 'success' or 'testfailed'.
+        Returns False if the series already has a run of the same revision at
+        the same time, e.g. when a backfill is repeated.
+
+        """
+        key = series_key(test_type, device, memory, app)
+        timestamp = int(timestamp)
+        revision = str(revision or '')[:40]
+        status = str(status or '')[:10]
+
+        with self._lock():
+            # don't trust a cached index while other processes may have changed it
+            self._index_mtime = None
+            index = dict(self.index)
+            if key not in index:
+                index[key] = {
+                    'file': hashlib.sha1(key).hexdigest() + '.dat',
+                    'metrics': list(names or [row['metric'] for row in metrics])
+                }
+                self._replace(index[key]['file'], '')
+                self._replace(INDEX_FILE, json.dumps(index, indent=2, sort_keys=True))
+
+            series = index[key]
+            record = self._record_struct(series)
+
+            rows = dict((row['metric'], row) for row in metrics)
+            values = []
+            for name in series['metrics']:
+                row = rows.get(name, {})
+                values.extend(NAN if row.get(column) is None else float(row[column])
+                              for column in COLUMNS)
+            data = record.pack(timestamp, revision, status, *values)
+
+            series_path = os.path.join(self.path, series['file'])
+            with open(series_path, 'rb') as f:
+                count = os.fstat(f.fileno()).st_size // record.size
+                position = self._bisect(f, count, record.size, timestamp, right=True)
+
+                # check the runs with the same timestamp for the same revision
+                previous = position
+                while previous > 0:
+                    previous -= 1
+                    f.seek(previous * record.size)
+                    other_timestamp, other_revision, _ = struct.unpack(
+                        RECORD_HEADER, f.read(struct.calcsize(RECORD_HEADER)))
+                    if other_timestamp != timestamp:
+                        break
+                    if other_revision.rstrip('\0') == revision:
+                        return False
+
+                if position < count:
+                    # runs arriving out of order (backfills) rewrite the file to keep it sorted
+                    f.seek(0)
+                    head = f.read(position * record.size)
+                    tail = f.read((count - position) * record.size)
+                    self._replace(series['file'], head + data + tail)
+                    return True
+
+            with open(series_path, 'ab') as f:
+                # drop a partial record left behind by an interrupted write
+                f.truncate(count * record.size)
+                f.write(data)
+
+        return True
+
+    def query(self, test_type, device, memory, app, start=None, end=None):
+        """Return the runs of a series with `start` <= timestamp < `end`, oldest first.
+
+        Every run is a dictionary with the timestamp, the revision, the status,
+        and the metrics in the format of `RaptorResultParser.metrics`.
+
+        """
+        series = self.index.get(series_key(test_type, device, memory, app))
+        if not series:
+            return []
+
+        record = self._record_struct(series)
+        runs = []
+        for values in self._read(series, record, start, end):
+            metrics = []
+            for offset, name in enumerate(series['metrics']):
+                first = HEADER_FIELDS + offset * len(COLUMNS)
+                row = values[first:first + len(COLUMNS)]
+                if any(value == value for value in row):
+                    metric = {'metric': name}
+                    metric.update(zip(COLUMNS, row))
+                    metrics.append(metric)
+            runs.append({'timestamp': values[0],
+                         'revision': values[1].rstrip('\0'),
+                         'status': values[2].rstrip('\0'),
+                         'metrics': metrics})
+        return runs
+
+    def column(self, test_type, device, memory, app, metric, column='bound_95',
+               start=None, end=None, last=None, statuses=None):
+        """Return the timestamps, revisions and values of one column of a metric.
+
+        Runs without a value for the column are left out, and with `statuses`
+        also the runs whose job had a different status. With `last` only the
+        most recent `last` of the remaining runs are returned, and the file is
+        read backwards from the end of the time range until enough are found.
+
+        """
+        series = self.index.get(series_key(test_type, device, memory, app))
+        if not series or metric not in series['metrics']:
+            return [], [], []
+
+        offset = (HEADER_FIELDS + series['metrics'].index(metric) * len(COLUMNS) +
+                  COLUMNS.index(column))
+        record = self._record_struct(series)
+
+        span = last
+        while True:
+            records = self._read(series, record, start, end, span)
+            matching = [values for values in records
+                        if values[offset] == values[offset] and
+                        (statuses is None or values[2].rstrip('\0') in statuses)]
+            if last is None or len(matching) >= last or len(records) < span:
+                break
+            span *= 2
+
+        if last is not None:
+            matching = matching[-last:]
+        return ([values[0] for values in matching],
+                [values[1].rstrip('\0') for values in matching],
+                [values[offset] for values in matching])
+
+    def _read(self, series, record, start, end, last=None):
+        try:
+            f = open(os.path.join(self.path, series['file']), 'rb')
+        except IOError:
+            return []
+
+        with f:
+            count = os.fstat(f.fileno()).st_size // record.size
+            first = 0 if start is None else self._bisect(f, count, record.size, int(start))
+            stop = count if end is None else self._bisect(f, count, record.size, int(end))
+            if last is not None:
+                first = max(first, stop - last)
+            if first >= stop:
+                return []
+
+            f.seek(first * record.size)
+            data = f.read((stop - first) * record.size)
+
+        return [record.unpack_from(data, offset)
+                for offset in range(0, len(data), record.size)]
+
+
+def parse_time(value):
+    """Accept an epoch, or a date in the YYYY-MM-DD format."""
+    if value.isdigit():
+        return int(value)
+    return int(time.mktime(time.strptime(value, '%Y-%m-%d')))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Query the local history of Raptor results.')
+    parser.add_argument('--path',
+                        required=True,
+                        help='Directory of the result history.')
+    parser.add_argument('--series',
+                        help='The TEST_TYPE/DEVICE/MEMORY/APP series to show the runs of. '
+                             'Without it the series in the history are listed.')
+    parser.add_argument('--from',
+                        dest='start',
+                        type=parse_time,
+                        help='Only show runs at or after this time (epoch or YYYY-MM-DD).')
+    parser.add_argument('--to',
+                        dest='end',
+                        type=parse_time,
+                        help='Only show runs before this time (epoch or YYYY-MM-DD).')
+    parser.add_argument('--metric',
+                        help='Only show the given metric of the runs.')
+    parser.add_argument('--column',
+                        default='bound_95',
+                        choices=COLUMNS,
+                        help='The value column shown with --metric.')
+    parser.add_argument('--json',
+                        action='store_true',
+                        help='Print the runs as JSON.')
+    args = parser.parse_args()
+
+    history = ResultHistory(args.path)
+
+    if not args.series:
+        for key in history.series():
+            print('%s\t%d runs' % ('/'.join(key), history.count(*key)))
+        sys.exit(0)
+
+    key = args.series.split('/')
+    if len(key) != 4:
+        parser.error('--series has to be given as TEST_TYPE/DEVICE/MEMORY/APP')
+
+    if args.metric:
+        timestamps, revisions, values = history.column(*key, metric=args.metric,
+                                                       column=args.column,
+                                                       start=args.start, end=args.end)
+        runs = [{'timestamp': timestamp, 'revision': revision, args.column: value}
+                for timestamp, revision, value in zip(timestamps, revisions, values)]
+    else:
+        runs = history.query(*key, start=args.start, end=args.end)
+
+    if args.json:
+        print(json.dumps(runs, indent=2))
+    else:
+        for run in runs:
+            if args.metric:
+                print('%d\t%s\t%.2f' % (run['timestamp'], run['revision'], run[args.column]))
+            else:
+                print('%d\t%s\t%s' % (run['timestamp'], run['revision'], ' '.join(
+                    '%s=%.2f' % (metric['metric'], metric['bound_95'])
+                    for metric in run['metrics'])))
@@ -0,0 +1,48 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import Queue
+import sys
+import threading
+
+
+def map_concurrently(func, items, concurrency):
+    """Call `func` for every item on up to `concurrency` threads.
+
+    Returns the results in the order of `items`. If any of the calls raised,
+    the first exception in the order of `items` is re-raised once all calls
+    have finished.
+
+    """
+    items = list(items)
+    results = [None] * len(items)
+    errors = [None] * len(items)
+
+    queue = Queue.Queue()
+    for index in range(len(items)):
+        queue.put(index)
+
+    def worker():
+        while True:
+            try:
+                index = queue.get_nowait()
+            except Queue.Empty:
+                return
+
+            try:
+                results[index] = func(items[index])
+            except Exception:
+                errors[index] = sys.exc_info()
+
+    threads = [threading.Thread(target=worker) for _ in range(min(concurrency, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for error in errors:
+        if error:
+            raise error[0], error[1], error[2]
+
+    return results
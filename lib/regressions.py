@@ -0,0 +1,158 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import argparse
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from history import ResultHistory
+
+
+class RegressionDetector(object):
+    """Find the runs after which the results of a series got worse.
+
+    The last `window` values of every series in the history are loaded into
+    one matrix, right aligned and padded with NaN. For every possible split of
+    a series into runs before and after, the Welch t statistic of the two
+    segments is computed from cumulative sums, for all series and splits at
+    once. A series has regressed at the split with the largest increase, if
+    its t statistic exceeds `t_threshold`, the mean grew by more than
+    `min_change` (relative), and both segments have at least `min_segment`
+    runs.
+
+    Needs numpy. Without it no regressions are detected.
+
+    """
+
+    def __init__(self, history, metric, column, window, min_segment, t_threshold, min_change):
+        self.history = history
+        self.metric = metric
+        self.column = column
+        self.window = window
+        self.min_segment = min_segment
+        self.t_threshold = t_threshold
+        self.min_change = min_change
+
+    @property
+    def available(self):
+        return numpy is not None
+
+    def detect(self, keys=None):
+        """Return the regressions of the given, or all series, largest t statistic first.
+
+        Every regression is a dictionary with the series, and the revision and
+        timestamp of the first run after the shift, next to the mean values
+        before and after it.
+
+        """
+        if not self.available:
+            return []
+
+        keys = list(keys if keys is not None else self.history.series())
+        if not keys:
+            return []
+
+        values = numpy.empty((len(keys), self.window))
+        values.fill(numpy.nan)
+        runs = []
+        for row, key in enumerate(keys):
+            timestamps, revisions, column = self.history.column(
+                *key, metric=self.metric, column=self.column, last=self.window)
+            if column:
+                values[row, self.window - len(column):] = column
+            padding = [None] * (self.window - len(column))
+            runs.append(zip(padding + timestamps, padding + revisions))
+
+        valid = ~numpy.isnan(values)
+        x = numpy.where(valid, values, 0.0)
+
+        # sums of the runs before every split, and of the runs after it
+        count = numpy.cumsum(valid, axis=1).astype(float)
+        total = numpy.cumsum(x, axis=1)
+        squares = numpy.cumsum(x * x, axis=1)
+        n_before, s_before, q_before = count[:, :-1], total[:, :-1], squares[:, :-1]
+        n_after = count[:, -1:] - n_before
+        s_after = total[:, -1:] - s_before
+        q_after = squares[:, -1:] - q_before
+
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            mean_before = s_before / n_before
+            mean_after = s_after / n_after
+            var_before = (q_before - s_before * mean_before) / (n_before - 1)
+            var_after = (q_after - s_after * mean_after) / (n_after - 1)
+            t = (mean_after - mean_before) / numpy.sqrt(
+                numpy.maximum(var_before, 0) / n_before + numpy.maximum(var_after, 0) / n_after)
+            change = (mean_after - mean_before) / mean_before
+
+        # a shift without any noise gives an infinite statistic, which is kept
+        t[numpy.isnan(t)] = 0
+        t[(n_before < self.min_segment) | (n_after < self.min_segment)] = 0
+
+        rows = numpy.arange(len(keys))
+        split = numpy.argmax(t, axis=1)
+        best = t[rows, split]
+        best_change = numpy.nan_to_num(change[rows, split])
+
+        regressions = []
+        for row in numpy.nonzero((best > self.t_threshold) &
+                                 (best_change > self.min_change))[0]:
+            timestamp, revision = runs[row][split[row] + 1]
+            regressions.append({
+                'series': keys[row],
+                'revision': revision,
+                'timestamp': timestamp,
+                'before': float(mean_before[row, split[row]]),
+                'after': float(mean_after[row, split[row]]),
+                'change': float(best_change[row]),
+                't': float(best[row])
+            })
+
+        regressions.sort(key=lambda regression: -regression['t'])
+        return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Detect regressions in the local history '
+                                                 'of Raptor results.')
+    parser.add_argument('--path',
+                        required=True,
+                        help='Directory of the result history.')
+    parser.add_argument('--metric',
+                        default='visuallyLoaded',
+                        help='The metric to look for regressions in.')
+    parser.add_argument('--column',
+                        default='bound_95',
+                        help='The value column of the metric.')
+    parser.add_argument('--window',
+                        type=int,
+                        default=60,
+                        help='The number of recent runs of every series to look at.')
+    parser.add_argument('--min-segment',
+                        type=int,
+                        default=5,
+                        help='The minimum number of runs before and after a shift.')
+    parser.add_argument('--t-threshold',
+                        type=float,
+                        default=5,
+                        help='The minimum t statistic of a shift.')
+    parser.add_argument('--min-change',
+                        type=float,
+                        default=0.05,
+                        help='The minimum relative increase of the mean of a shift.')
+    args = parser.parse_args()
+
+    if numpy is None:
+        parser.error('numpy is required to detect regressions')
+
+    detector = RegressionDetector(ResultHistory(args.path), args.metric, args.column,
+                                  args.window, args.min_segment, args.t_threshold,
+                                  args.min_change)
+    for regression in detector.detect():
+        print('%s\t%s\t%+.1f%%\t%.2f -> %.2f\tt=%.1f' % (
+            '/'.join(regression['series']), regression['revision'],
+            regression['change'] * 100, regression['before'], regression['after'],
+            regression['t']))
@@ -0,0 +1,198 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import argparse
+import cgi
+import os
+import time
+
+from history import ResultHistory
+from utils import atomic_write
+
+WIDTH = 640
+HEIGHT = 240
+MARGIN = 40
+
+HTML_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<style>
+body {{ font-family: sans-serif; font-size: 13px; }}
+svg text {{ font-size: 11px; fill: #555; }}
+</style>
+</head>
+<body>
+<h1>{title}</h1>
+{body}
+<p>Generated {generated}</p>
+</body>
+</html>
+"""
+
+
+def lttb(points, budget):
+    """Downsample (x, y) points to `budget` points with Largest-Triangle-Three-Buckets.
+
+    The first and last points are kept. The points in between are split into
+    `budget` - 2 buckets, and from every bucket the point forming the largest
+    triangle with the previously picked point and the average of the next
+    bucket is kept, which preserves spikes and the overall shape.
+
+    """
+    if budget >= len(points) or budget < 3:
+        return list(points)
+
+    sampled = [points[0]]
+    size = (len(points) - 2) / float(budget - 2)
+    previous = points[0]
+
+    for bucket in range(budget - 2):
+        start = int(bucket * size) + 1
+        end = int((bucket + 1) * size) + 1
+
+        # average of the next bucket, or the last point for the last bucket
+        following = points[end:min(int((bucket + 2) * size) + 1, len(points))] or [points[-1]]
+        average_x = sum(x for x, _ in following) / float(len(following))
+        average_y = sum(y for _, y in following) / float(len(following))
+
+        best = None
+        best_area = -1
+        for point in points[start:end]:
+            area = abs((previous[0] - average_x) * (point[1] - previous[1]) -
+                       (previous[0] - point[0]) * (average_y - previous[1]))
+            if area > best_area:
+                best, best_area = point, area
+
+        sampled.append(best)
+        previous = best
+
+    sampled.append(points[-1])
+    return sampled
+
+
+def render_svg(points, threshold=None, width=WIDTH, height=HEIGHT):
+    """Render (timestamp, value) points as a line chart, with an optional threshold line."""
+    if not points:
+        return '<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d"></svg>' % (
+            width, height)
+
+    xs = [x for x, _ in points]
+    ys = [y for _, y in points]
+    if threshold is not None:
+        ys.append(threshold)
+    min_x, max_x = min(xs), max(xs)
+    min_y, max_y = min(ys), max(ys)
+    span_x = float(max_x - min_x) or 1
+    span_y = float(max_y - min_y) or 1
+
+    def scale(x, y):
+        return (MARGIN + (x - min_x) / span_x * (width - 2 * MARGIN),
+                height - MARGIN - (y - min_y) / span_y * (height - 2 * MARGIN))
+
+    polyline = ' '.join('%.1f,%.1f' % scale(x, y) for x, y in points)
+    parts = [
+        '<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d">' % (width, height),
+        '<rect x="%d" y="%d" width="%d" height="%d" fill="none" stroke="#ccc"/>' % (
+            MARGIN, MARGIN, width - 2 * MARGIN, height - 2 * MARGIN),
+        '<polyline fill="none" stroke="#1f77b4" stroke-width="1.5" points="%s"/>' % polyline,
+        '<text x="2" y="%d">%.0f</text>' % (MARGIN + 4, max_y),
+        '<text x="2" y="%d">%.0f</text>' % (height - MARGIN + 4, min_y),
+        '<text x="%d" y="%d">%s</text>' % (
+            MARGIN, height - MARGIN / 2, time.strftime('%Y-%m-%d', time.gmtime(min_x))),
+        '<text x="%d" y="%d" text-anchor="end">%s</text>' % (
+            width - MARGIN, height - MARGIN / 2, time.strftime('%Y-%m-%d', time.gmtime(max_x))),
+    ]
+    if threshold is not None:
+        _, y = scale(min_x, threshold)
+        parts.append('<line x1="%d" y1="%.1f" x2="%d" y2="%.1f" stroke="#d62728" '
+                     'stroke-dasharray="4,3"/>' % (MARGIN, y, width - MARGIN, y))
+    parts.append('</svg>')
+    return '\n'.join(parts)
+
+
+class TrendReport(object):
+    """Static HTML trend charts of the series in the result history.
+
+    Every (test type, device, memory, app) series gets a self-contained HTML
+    file with an inline SVG chart of one metric column. Long series are
+    downsampled to `points` points, so reports stay small however much
+    history there is.
+
+    """
+
+    def __init__(self, history, metric, column, points):
+        self.history = history
+        self.metric = metric
+        self.column = column
+        self.points = points
+
+    def svg(self, test_type, device, memory, app, start=None, threshold=None):
+        timestamps, _, values = self.history.column(test_type, device, memory, app,
+                                                    metric=self.metric, column=self.column,
+                                                    start=start)
+        return render_svg(lttb(zip(timestamps, values), self.points), threshold=threshold)
+
+    def html(self, title, body):
+        return HTML_TEMPLATE.format(title=cgi.escape(title), body=body,
+                                    generated=time.strftime('%Y-%m-%d %H:%M:%S UTC',
+                                                            time.gmtime()))
+
+    def write(self, path, name, content):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        # temporary files are private, but reports are meant to be served
+        atomic_write(os.path.join(path, name), content, mode=0644)
+        return os.path.join(path, name)
+
+    def write_series(self, path, key, start=None, threshold=None):
+        """Write the report of a single series, and return its file name."""
+        title = '%s %s %s (%s)' % (' / '.join(key), self.metric, self.column,
+                                   '%d runs' % self.history.count(*key))
+        name = '%s.html' % '-'.join(key)
+        self.write(path, name, self.html(title, self.svg(*key, start=start,
+                                                           threshold=threshold)))
+        return name
+
+    def write_all(self, path, start=None):
+        """Write the reports of all series, and an index linking to them."""
+        links = []
+        for key in self.history.series():
+            name = self.write_series(path, key, start=start)
+            links.append('<li><a href="%s">%s</a></li>' % (
+                cgi.escape(name, quote=True), cgi.escape(' / '.join(key))))
+
+        return self.write(path, 'index.html', self.html(
+            'Raptor %s trends' % self.metric, '<ul>\n%s\n</ul>' % '\n'.join(links)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write HTML trend reports of the local '
+                                                 'history of Raptor results.')
+    parser.add_argument('--path',
+                        required=True,
+                        help='Directory of the result history.')
+    parser.add_argument('--output',
+                        required=True,
+                        help='Directory to write the reports to.')
+    parser.add_argument('--metric',
+                        default='visuallyLoaded',
+                        help='The metric to chart.')
+    parser.add_argument('--column',
+                        default='bound_95',
+                        help='The value column of the metric.')
+    parser.add_argument('--points',
+                        type=int,
+                        default=200,
+                        help='Maximum number of points per chart.')
+    parser.add_argument('--days',
+                        type=int,
+                        help='Only chart the runs of the last DAYS days.')
+    args = parser.parse_args()
+
+    start = time.time() - args.days * 86400 if args.days else None
+    report = TrendReport(ResultHistory(args.path), args.metric, args.column, args.points)
+    print('Wrote %s' % report.write_all(args.output, start=start))
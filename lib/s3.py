@@ -5,105 +5,670 @@
 # Original source:
 # https://github.com/mozilla/mozmill-ci/blob/master/jenkins-master/jobs/scripts/workspace/s3.py
 
+import glob
 import gzip
+import hashlib
+import json
 import logging
 import os
+import Queue
 import re
+import struct
 import sys
-import tempfile
+import threading
+import time
+import zlib
 
+from bisect import bisect_left
+from collections import deque
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
 from optparse import OptionParser
 
 import boto
 import boto.s3.connection
 
+from utils import atomic_write
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 # Set the logger globally in the file, but this must be reset when
 # used in a child process.
 logger = logging.getLogger()
 
+# S3 connections shared by all S3Bucket instances, keyed by credentials
+_connections = {}
+_connections_lock = threading.Lock()
+
+# Size of the blocks read from files to upload
+READ_SIZE = 1024 * 1024
+# Size of the parts of multipart uploads, S3 requires at least 5MB
+PART_SIZE = 8 * 1024 * 1024
+# Number of compressed parts which may wait to be uploaded
+PART_QUEUE_SIZE = 2
+# Seconds between checks whether a blocked part producer has been cancelled
+PART_QUEUE_POLL_INTERVAL = 0.1
+
+# Supported codecs and the Content-Encoding they are uploaded with
+CODECS = {'gzip': 'gzip', 'zstd': 'zstd'}
+COMPRESSION_LEVEL = 9
+
+# Key metadata holding the SHA-256 of the uncompressed file contents
+DIGEST_METADATA = 'content-sha256'
+
+# Suffix of the keys holding the block index of keys uploaded with `indexed`
+INDEX_SUFFIX = '.idx'
+# Uncompressed size of the blocks of indexed uploads, which bounds the size of ranged reads
+INDEX_BLOCK_SIZE = 256 * 1024
+
+# Maximum number of keys S3 deletes with a single multi-object delete request
+DELETE_BATCH_SIZE = 1000
+
+REGEX_SPECIAL = '.^$*+?{}[]\\|()'
+
 
 class S3Error(Exception):
     def __init__(self, message):
         Exception.__init__(self, 'S3Error: %s' % message)
 
 
+def literal_prefix(keypattern):
+    """Return the literal prefix every key matched by the pattern has to start with.
+
+    The prefix ends at the first regular expression construct, and is empty
+    if the pattern contains an alternation or is case insensitive.
+
+    """
+    if not isinstance(keypattern, basestring):
+        if keypattern.flags & re.IGNORECASE:
+            return ''
+        keypattern = keypattern.pattern
+
+    if '|' in keypattern:
+        return ''
+
+    prefix = []
+    i = 1 if keypattern.startswith('^') else 0
+    while i < len(keypattern):
+        char = keypattern[i]
+        if char == '\\' and i + 1 < len(keypattern) and not keypattern[i + 1].isalnum():
+            # escaped special character
+            char = keypattern[i + 1]
+            i += 2
+        elif char in REGEX_SPECIAL:
+            break
+        else:
+            i += 1
+
+        if i < len(keypattern) and keypattern[i] in '*?{':
+            # the character is optional
+            break
+        prefix.append(char)
+        if i < len(keypattern) and keypattern[i] == '+':
+            break
+
+    return ''.join(prefix)
+
+
+class KeyIndex(object):
+    """Local, sorted index of the key names of a bucket.
+
+    The index is refreshed incrementally by listing only the keys after the
+    last known one. S3 lists keys in lexicographical order, so keys added with
+    a name sorting before that marker, or deleted by other clients, are only
+    picked up by a full refresh.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.names = []
+
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self.names = [line.rstrip('\n') for line in f]
+
+    def save(self):
+        atomic_write(self.path, ''.join(name + '\n' for name in self.names))
+
+    def refresh(self, bucket, full=False):
+        if full:
+            self.names = []
+
+        marker = self.names[-1] if self.names else ''
+        added = [key.name for key in bucket.list(marker=marker)]
+        self.names.extend(added)
+        self.save()
+
+        logger.debug('Added %d keys to index %s' % (len(added), self.path))
+
+    def remove(self, names):
+        names = set(names)
+        self.names = [name for name in self.names if name not in names]
+        self.save()
+
+    def match(self, keypattern, prefix=''):
+        """Return the names starting with `prefix` which match the compiled pattern."""
+        matches = []
+        for name in self.names[bisect_left(self.names, prefix):]:
+            if not name.startswith(prefix):
+                break
+            if keypattern.match(name):
+                matches.append(name)
+
+        return matches
+
+
+def file_digest(path):
+    """Return the SHA-256 hex digest of a file, reading it in blocks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(READ_SIZE), ''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def gzip_parts(path, part_size, level=COMPRESSION_LEVEL):
+    """Compress a file and yield the gzip stream in parts of at least `part_size` bytes."""
+    buf = StringIO()
+    with gzip.GzipFile(path, 'wb', level, fileobj=buf) as gz:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(READ_SIZE), ''):
+                gz.write(block)
+                if buf.tell() >= part_size:
+                    yield buf.getvalue()
+                    buf.seek(0)
+                    buf.truncate()
+
+    yield buf.getvalue()
+
+
+def deflate_block(block, level):
+    # a sync flush ends the block on a byte boundary without finishing the stream,
+    # so the output of independently compressed blocks can be concatenated
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def parallel_gzip_parts(path, part_size, level=COMPRESSION_LEVEL, workers=2, index=None,
+                        block_size=READ_SIZE):
+    """Compress a file on several threads, like pigz, and yield a single gzip stream.
+
+    The file is split into blocks which are deflated independently on a pool of
+    threads (zlib releases the GIL), while the checksum is computed in order on
+    the calling thread. At most 2 * `workers` blocks are in flight at a time.
+
+    As every block starts on a byte boundary without referring to earlier data,
+    it can be inflated on its own. If an `index` list is given, the
+    (uncompressed offset, compressed offset) pair of each block is appended.
+
+    """
+    pool = ThreadPool(workers)
+    pending = deque()
+    buf = StringIO()
+    crc = zlib.crc32('')
+    size = 0
+
+    # gzip header: magic, deflate, no flags, mtime, no extra flags, unknown OS
+    buf.write('\x1f\x8b\x08\x00' + struct.pack('<I', int(time.time())) + '\x00\xff')
+    compressed_size = buf.tell()
+
+    try:
+        with open(path, 'rb') as f:
+            while True:
+                block = f.read(block_size)
+                if block:
+                    pending.append((size, pool.apply_async(deflate_block, (block, level))))
+                    crc = zlib.crc32(block, crc)
+                    size += len(block)
+
+                if pending and (not block or len(pending) >= 2 * workers):
+                    offset, result = pending.popleft()
+                    deflated = result.get()
+                    if index is not None:
+                        index.append((offset, compressed_size))
+                    compressed_size += len(deflated)
+
+                    buf.write(deflated)
+                    if buf.tell() >= part_size:
+                        yield buf.getvalue()
+                        buf.seek(0)
+                        buf.truncate()
+                elif not block:
+                    break
+    finally:
+        pool.terminate()
+
+    # empty final block, followed by the checksum and size of the uncompressed data
+    buf.write(zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS).flush())
+    buf.write(struct.pack('<II', crc & 0xffffffff, size & 0xffffffff))
+    yield buf.getvalue()
+
+
+def zstd_parts(path, part_size, level=COMPRESSION_LEVEL, workers=1):
+    """Compress a file with zstd and yield the stream in parts of at least `part_size` bytes."""
+    if not zstandard:
+        raise S3Error('zstd compression requires the zstandard package')
+
+    compressor = zstandard.ZstdCompressor(level=level, threads=workers).compressobj()
+    buf = StringIO()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(READ_SIZE), ''):
+            buf.write(compressor.compress(block))
+            if buf.tell() >= part_size:
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+
+    buf.write(compressor.flush())
+    yield buf.getvalue()
+
+
+def compressed_parts(path, part_size, codec='gzip', level=COMPRESSION_LEVEL, workers=1,
+                     index=None):
+    if codec == 'zstd':
+        return zstd_parts(path, part_size, level, workers)
+    if index is not None:
+        return parallel_gzip_parts(path, part_size, level, workers, index, INDEX_BLOCK_SIZE)
+    if workers > 1:
+        return parallel_gzip_parts(path, part_size, level, workers)
+    return gzip_parts(path, part_size, level)
+
+
+class PartProducer(threading.Thread):
+    """Produce the parts of an upload on a separate thread.
+
+    The parts are passed through a bounded queue, so producing the next parts
+    overlaps with uploading the current one without the memory growing. If
+    the upload fails, `cancel` has to be called so the thread stops and closes
+    the file instead of waiting for the queue forever.
+
+    """
+    DONE = object()
+
+    def __init__(self, parts):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.parts = parts
+        self.queue = Queue.Queue(PART_QUEUE_SIZE)
+        self.cancelled = threading.Event()
+        self.error = None
+
+    def run(self):
+        try:
+            for part in self.parts:
+                if not self._put(part):
+                    break
+        except Exception:
+            self.error = sys.exc_info()
+        finally:
+            # releases the file and the compression workers of the generator
+            if hasattr(self.parts, 'close'):
+                self.parts.close()
+        self._put(self.DONE)
+
+    def _put(self, item):
+        while not self.cancelled.is_set():
+            try:
+                self.queue.put(item, timeout=PART_QUEUE_POLL_INTERVAL)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def cancel(self):
+        self.cancelled.set()
+
+        # drop the queued parts, so their memory is freed right away
+        while True:
+            try:
+                self.queue.get_nowait()
+            except Queue.Empty:
+                break
+
+    def get(self):
+        """Return the next part, or DONE once all parts have been produced."""
+        part = self.queue.get()
+        if part is self.DONE and self.error:
+            raise self.error[0], self.error[1], self.error[2]
+        return part
+
+
 class S3Bucket(object):
 
-    def __init__(self, bucket_name, access_key_id, access_secret_key):
+    def __init__(self, bucket_name, access_key_id, access_secret_key, index_path=None):
         self._bucket = None
+        self._index = None
+
+        # destinations whose upload was skipped, as they already had the same contents
+        self.skipped = []
 
         self.bucket_name = bucket_name
         self.access_key_id = access_key_id
         self.access_secret_key = access_secret_key
+        self.index_path = index_path
+
+    @property
+    def index(self):
+        """The local key index, refreshed when first used, or None if not enabled."""
+        if self.index_path and self._index is None:
+            self.refresh_index()
+        return self._index
+
+    def refresh_index(self, full=False):
+        # load the index here, reading `index` would refresh it a first time
+        if self._index is None:
+            self._index = KeyIndex(self.index_path)
+
+        try:
+            self._index.refresh(self.bucket, full=full)
+        except boto.exception.S3ResponseError, e:
+            logger.exception(str(e))
+            raise S3Error('%s' % e)
+
+    @property
+    def connection(self):
+        """The S3 connection shared with all other buckets using the same credentials."""
+        credentials = (self.access_key_id, self.access_secret_key)
+        with _connections_lock:
+            if credentials not in _connections:
+                _connections[credentials] = boto.s3.connection.S3Connection(*credentials)
+            return _connections[credentials]
 
     @property
     def bucket(self):
         if self._bucket:
             return self._bucket
         try:
-            conn = boto.s3.connection.S3Connection(self.access_key_id,
-                                                   self.access_secret_key)
-            if not conn.lookup(self.bucket_name):
-                raise S3Error('bucket %s not found' % self.bucket_name)
-            if not self._bucket:
-                self._bucket = conn.get_bucket(self.bucket_name)
+            # don't spend a request on checking the bucket exists, a missing
+            # bucket makes the first real request fail anyway
+            self._bucket = self.connection.get_bucket(self.bucket_name, validate=False)
             return self._bucket
         except boto.exception.NoAuthHandlerFound:
-            logger.exception()
+            logger.exception('Authentication failed')
             raise S3Error('Authentication failed')
-        except boto.exception.S3ResponseError, e:
-            logger.exception()
-            raise S3Error('%s' % e)
 
     def ls(self, keypattern='.*'):
         if isinstance(keypattern, str):
             keypattern = re.compile(keypattern)
-        keys = [key for key in self.bucket.list() if keypattern.match(key.name)]
+
+        # only list the keys which can match at all
+        prefix = literal_prefix(keypattern)
+        if self.index:
+            return [self.bucket.new_key(name) for name in self.index.match(keypattern, prefix)]
+
+        try:
+            keys = [key for key in self.bucket.list(prefix=prefix) if keypattern.match(key.name)]
+        except boto.exception.S3ResponseError, e:
+            logger.exception(str(e))
+            raise S3Error('%s' % e)
         return keys
 
-    def rm(self, keys):
+    def rm(self, keys, dry_run=False, workers=4):
+        """Delete keys with multi-object delete requests of up to DELETE_BATCH_SIZE keys.
+
+        Up to `workers` requests are sent at the same time. Returns the names
+        of the deleted keys, and a list of (name, code, message) tuples for
+        the keys which could not be deleted. With `dry_run` nothing is deleted.
+
+        """
         assert isinstance(keys, list) or isinstance(keys, str)
 
         if isinstance(keys, str):
             keys = self.ls(keys)
+        names = [key.name for key in keys]
+
+        if dry_run:
+            for name in names:
+                logger.info('Would delete: %s' % name)
+            return [], []
+
+        batches = [names[i:i + DELETE_BATCH_SIZE]
+                   for i in range(0, len(names), DELETE_BATCH_SIZE)]
+
+        deleted = []
+        errors = []
+
+        def delete(batch):
+            result = self.bucket.delete_keys(batch, quiet=False)
+            deleted.extend(key.key for key in result.deleted)
+            errors.extend((error.key, error.code, error.message) for error in result.errors)
+
+        # connect before the threads start, so they all share the same connection
+        self.bucket
+
+        pool = ThreadPool(workers)
         try:
-            for key in keys:
-                key.delete()
+            pool.map(delete, batches)
         except boto.exception.S3ResponseError, e:
             logger.exception(str(e))
             raise S3Error('%s' % e)
+        finally:
+            pool.close()
+            pool.join()
+
+            if self.index:
+                self.index.remove(deleted)
+
+        for name, code, message in errors:
+            logger.error('Failed to delete %s: %s %s' % (name, code, message))
+        logger.info('Deleted %d keys in %d requests, %d failed' % (
+            len(deleted), len(batches), len(errors)))
+
+        return deleted, errors
 
-    def upload(self, path, destination):
+    def upload(self, path, destination, codec='gzip', level=COMPRESSION_LEVEL, workers=1,
+               force=False, indexed=False):
+        """Compress and upload a file, and return its URL.
+
+        Compression uses `workers` threads and the given `codec`, either 'gzip',
+        or 'zstd' for buckets only read by tooling which supports it. The upload
+        is skipped if the key already holds the same contents with the same
+        encoding, and with `indexed` an index, unless `force` is set. Checking
+        that takes a HEAD request, so with `force` a small file is uploaded
+        with a single request.
+
+        With `indexed` a gzip file is compressed in independent blocks, and the
+        offsets of the blocks are stored next to it, so `read_tail` can fetch
+        and decompress just the end of the file.
+
+        """
+        if codec not in CODECS:
+            raise S3Error('unknown codec %s' % codec)
+        if indexed and codec != 'gzip':
+            raise S3Error('only gzip uploads can be indexed')
+
+        producer = None
         try:
-            key = self.bucket.get_key(destination)
-            if not key:
-                logger.debug('Creating key: %s' % destination)
-                key = self.bucket.new_key(destination)
+            digest = file_digest(path)
 
+            existing = None if force else self.bucket.get_key(destination)
+            # a key stored without an index has to be uploaded again to get one
+            if (existing and existing.get_metadata(DIGEST_METADATA) == digest and
+                    existing.content_encoding == CODECS[codec] and
+                    (not indexed or self.bucket.get_key(destination + INDEX_SUFFIX))):
+                logger.info('Skipping upload of %s, %s has the same contents' % (path, destination))
+                self.skipped.append(destination)
+                return existing.generate_url(expires_in=0,
+                                             query_auth=False)
+
+            # always upload through a new key, boto would send the metadata of an
+            # existing key along and overwrite the digest of the new contents
+            logger.debug('Creating key: %s' % destination)
+            key = self.bucket.new_key(destination)
+
+            headers = {'Content-Encoding': CODECS[codec],
+                       'x-amz-meta-%s' % DIGEST_METADATA: digest}
             ext = os.path.splitext(path)[-1]
             if ext == '.log' or ext == '.txt':
-                key.set_metadata('Content-Type', 'text/plain')
-
-            with tempfile.NamedTemporaryFile('w+b', suffix=ext) as tf:
-                logger.debug('Compressing: %s' % path)
-                with gzip.GzipFile(path, 'wb', fileobj=tf) as gz:
-                    with open(path, 'rb') as f:
-                        gz.writelines(f)
-                tf.flush()
-                tf.seek(0)
-                key.set_metadata('Content-Encoding', 'gzip')
-                logger.debug('Setting key contents from: %s' % tf.name)
-                key.set_contents_from_file(tf)
+                headers['Content-Type'] = 'text/plain'
+
+            index = [] if indexed else None
+            logger.debug('Compressing with %s on %d threads: %s' % (codec, workers, path))
+            producer = PartProducer(compressed_parts(path, PART_SIZE, codec, level, workers,
+                                                     index))
+            producer.start()
+
+            part = producer.get()
+            next_part = producer.get()
+            if next_part is PartProducer.DONE:
+                # small enough for a single request
+                logger.debug('Setting key contents of: %s' % destination)
+                key.set_contents_from_string(part, headers=headers)
+            else:
+                self._upload_parts(destination, headers, producer, [part, next_part])
+
+            if indexed:
+                index_key = self.bucket.new_key(destination + INDEX_SUFFIX)
+                index_key.set_contents_from_string(
+                    json.dumps({'size': os.path.getsize(path), 'blocks': index}),
+                    headers={'Content-Type': 'application/json'})
 
             url = key.generate_url(expires_in=0,
                                    query_auth=False)
         except boto.exception.S3ResponseError, e:
             logger.exception(str(e))
             raise S3Error('%s' % e)
+        finally:
+            if producer:
+                producer.cancel()
 
         logger.debug('File %s uploaded to: %s' % (path, url))
         return url
 
+    def supports_tail(self, name):
+        """Return whether `read_tail` can fetch just the end of a key, not all of it."""
+        try:
+            key = self.bucket.get_key(name)
+            if not key:
+                raise S3Error('key %s not found' % name)
+
+            if not key.content_encoding:
+                return True
+            return (key.content_encoding == 'gzip' and
+                    self.bucket.get_key(name + INDEX_SUFFIX) is not None)
+        except boto.exception.S3ResponseError, e:
+            logger.exception(str(e))
+            raise S3Error('%s' % e)
+
+    def read_tail(self, name, size):
+        """Return at least the last `size` bytes of the uncompressed contents of a key.
+
+        Returns a tuple of the data and whether it is the complete contents.
+        Only the needed byte range is fetched for uncompressed keys and for
+        gzip keys uploaded with `indexed`, all others have to be downloaded
+        and decompressed completely, but only their tail is kept in memory.
+
+        """
+        try:
+            key = self.bucket.get_key(name)
+            if not key:
+                raise S3Error('key %s not found' % name)
+
+            if not key.content_encoding:
+                if key.size <= size:
+                    return key.get_contents_as_string(), True
+                return key.get_contents_as_string(headers={'Range': 'bytes=-%d' % size}), False
+
+            if key.content_encoding == 'gzip':
+                index_key = self.bucket.get_key(name + INDEX_SUFFIX)
+                if index_key:
+                    index = json.loads(index_key.get_contents_as_string())
+
+                    # the last block which starts early enough
+                    offset, compressed_offset = 0, index['blocks'][0][1] if index['blocks'] else 0
+                    for block in index['blocks']:
+                        if index['size'] - block[0] < size:
+                            break
+                        offset, compressed_offset = block
+
+                    data = key.get_contents_as_string(
+                        headers={'Range': 'bytes=%d-' % compressed_offset})
+                    logger.debug('Fetched %d of %d bytes of %s' % (len(data), key.size, name))
+                    return zlib.decompressobj(-zlib.MAX_WBITS).decompress(data), offset == 0
+
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            elif key.content_encoding == 'zstd' and zstandard:
+                decompressor = zstandard.ZstdDecompressor().decompressobj()
+            else:
+                raise S3Error('unsupported encoding %s of key %s' % (key.content_encoding, name))
+
+            # no way to seek, so decompress everything but only keep the tail
+            tail = ''
+            complete = True
+            for block in iter(lambda: key.read(READ_SIZE), ''):
+                tail += decompressor.decompress(block)
+                if len(tail) > size:
+                    tail = tail[-size:]
+                    complete = False
+            key.close()
+
+            return tail, complete
+        except boto.exception.S3ResponseError, e:
+            logger.exception(str(e))
+            raise S3Error('%s' % e)
+
+    def upload_many(self, pattern, key_template, upload_workers=4, **kwargs):
+        """Upload all files in a directory, or matching a glob pattern, concurrently.
+
+        The key of each file is built from `key_template`, which may use the
+        fields {path} (relative to the directory, or the part of the pattern
+        before the first wildcard), {name} and {stem}. All uploads share the
+        connection of this bucket. Further arguments are passed to `upload`.
+        Returns the URLs in the order of the sorted file paths.
+
+        """
+        if os.path.isdir(pattern):
+            root = pattern
+            paths = [os.path.join(dirpath, name)
+                     for dirpath, _, names in os.walk(pattern) for name in names]
+        else:
+            root = pattern
+            while glob.has_magic(root):
+                root = os.path.dirname(root)
+            paths = [path for path in glob.glob(pattern) if os.path.isfile(path)]
+
+        def upload(path):
+            name = os.path.basename(path)
+            destination = key_template.format(
+                path=os.path.relpath(path, root or os.curdir).replace(os.sep, '/'),
+                name=name,
+                stem=os.path.splitext(name)[0])
+            return self.upload(path, destination, **kwargs)
+
+        # connect before the threads start, so they all share the same connection
+        self.bucket
+
+        pool = ThreadPool(upload_workers)
+        try:
+            return pool.map(upload, sorted(paths))
+        finally:
+            pool.close()
+            pool.join()
+
+    def _upload_parts(self, destination, headers, producer, parts):
+        """Upload the given parts and all remaining ones of the producer as a multipart upload."""
+        logger.debug('Starting multipart upload of: %s' % destination)
+        mp = self.bucket.initiate_multipart_upload(destination, headers=headers)
+        try:
+            part_num = 0
+            while True:
+                part = parts.pop(0) if parts else producer.get()
+                if part is PartProducer.DONE:
+                    break
+                part_num += 1
+                mp.upload_part_from_file(StringIO(part), part_num)
+
+            mp.complete_upload()
+            logger.debug('Uploaded %d parts to: %s' % (part_num, destination))
+        except:
+            mp.cancel_upload()
+            raise
+
 if __name__ == '__main__':
     logging.basicConfig()
     logger.setLevel(logging.INFO)
@@ -136,6 +701,23 @@ if __name__ == '__main__':
                       type='string',
                       default=None,
                       help='Delete matching keys in bucket.')
+    parser.add_option('--dry-run',
+                      dest='dry_run',
+                      action='store_true',
+                      default=False,
+                      help='Only show which keys --rm would delete.')
+    parser.add_option('--index',
+                      dest='index',
+                      action='store',
+                      type='string',
+                      default=None,
+                      help="""Local file with an index of the bucket keys,
+                      used by --ls and --rm instead of listing the bucket.""")
+    parser.add_option('--rebuild-index',
+                      dest='rebuild_index',
+                      action='store_true',
+                      default=False,
+                      help='Rebuild the --index from a full listing of the bucket.')
     parser.add_option('--upload',
                       dest='upload',
                       action='store',
@@ -152,6 +734,64 @@ if __name__ == '__main__':
                       help="""Bucket key for uploaded file.
                       If --upload is specified, --key must also
                       be specified.""")
+    parser.add_option('--upload-many',
+                      dest='upload_many',
+                      action='store',
+                      type='string',
+                      default=None,
+                      help="""Directory or glob pattern of files to upload
+                      concurrently. If --upload-many is specified,
+                      --key-template must also be specified.""")
+    parser.add_option('--key-template',
+                      dest='key_template',
+                      action='store',
+                      type='string',
+                      default=None,
+                      help="""Bucket key template for --upload-many, which
+                      may use {path}, {name} and {stem} of each file.""")
+    parser.add_option('--upload-workers',
+                      dest='upload_workers',
+                      type='int',
+                      default=4,
+                      help='Number of files uploaded at the same time by --upload-many.')
+    parser.add_option('--force',
+                      dest='force',
+                      action='store_true',
+                      default=False,
+                      help='Upload files even if the keys already have the same contents.')
+    parser.add_option('--indexed',
+                      dest='indexed',
+                      action='store_true',
+                      default=False,
+                      help="""Compress uploaded files in independent blocks
+                      and store an index, so --tail can fetch only the end.""")
+    parser.add_option('--tail',
+                      dest='tail',
+                      action='store',
+                      type='string',
+                      default=None,
+                      help='Print the end of the uncompressed contents of a key.')
+    parser.add_option('--tail-bytes',
+                      dest='tail_bytes',
+                      type='int',
+                      default=64 * 1024,
+                      help='Number of bytes printed by --tail.')
+    parser.add_option('--codec',
+                      dest='codec',
+                      type='choice',
+                      choices=sorted(CODECS.keys()),
+                      default='gzip',
+                      help='Compression codec for uploaded files.')
+    parser.add_option('--level',
+                      dest='level',
+                      type='int',
+                      default=COMPRESSION_LEVEL,
+                      help='Compression level for uploaded files.')
+    parser.add_option('--workers',
+                      dest='workers',
+                      type='int',
+                      default=1,
+                      help='Number of threads used to compress uploaded files.')
 
     (cmd_options, args) = parser.parse_args()
 
@@ -161,22 +801,49 @@ if __name__ == '__main__':
         parser.print_usage()
         sys.exit(1)
 
+    if ((cmd_options.upload_many or cmd_options.key_template) and (
+            not cmd_options.upload_many or not cmd_options.key_template)):
+        parser.error('--upload-many and --key-template must be specified together.')
+        parser.print_usage()
+        sys.exit(1)
+
     if (not cmd_options.bucket and
             not cmd_options.ls and
             not cmd_options.rm and
             not cmd_options.upload and
-            not cmd_options.key):
+            not cmd_options.key and
+            not cmd_options.upload_many and
+            not cmd_options.rebuild_index and
+            not cmd_options.tail):
         parser.print_usage()
         sys.exit(1)
 
     logger.debug('bucket %s' % cmd_options.bucket)
 
-    s3bucket = S3Bucket(cmd_options.bucket)
+    # boto takes the credentials from the environment or its config file
+    s3bucket = S3Bucket(cmd_options.bucket, None, None, index_path=cmd_options.index)
+    if cmd_options.rebuild_index:
+        s3bucket.refresh_index(full=True)
 
     if cmd_options.upload:
-        print s3bucket.upload(cmd_options.upload, cmd_options.key)
+        print s3bucket.upload(cmd_options.upload, cmd_options.key, codec=cmd_options.codec,
+                              level=cmd_options.level, workers=cmd_options.workers,
+                              force=cmd_options.force, indexed=cmd_options.indexed)
+    if cmd_options.upload_many:
+        for url in s3bucket.upload_many(cmd_options.upload_many, cmd_options.key_template,
+                                        upload_workers=cmd_options.upload_workers,
+                                        codec=cmd_options.codec, level=cmd_options.level,
+                                        workers=cmd_options.workers, force=cmd_options.force,
+                                        indexed=cmd_options.indexed):
+            print url
+    if s3bucket.skipped:
+        logger.info('Skipped %d uploads with unchanged contents' % len(s3bucket.skipped))
+    if cmd_options.tail:
+        sys.stdout.write(s3bucket.read_tail(cmd_options.tail, cmd_options.tail_bytes)[0])
     if cmd_options.ls:
         for key in s3bucket.ls(cmd_options.ls):
             print key.name
     if cmd_options.rm:
-        s3bucket.rm(cmd_options.rm)
+        deleted, errors = s3bucket.rm(cmd_options.rm, dry_run=cmd_options.dry_run)
+        if errors:
+            sys.exit(1)
@@ -0,0 +1,26 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class PooledSession(requests.Session):
+    """HTTP session with a keep-alive connection pool and default timeouts."""
+
+    def __init__(self, pool_size, connect_timeout, read_timeout):
+        super(PooledSession, self).__init__()
+
+        self.timeout = (connect_timeout, read_timeout)
+        self.adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.share_with(self)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super(PooledSession, self).request(method, url, **kwargs)
+
+    def share_with(self, session):
+        """Let another session, e.g. the one of a client library, use our connection pool."""
+        session.mount('http://', self.adapter)
+        session.mount('https://', self.adapter)
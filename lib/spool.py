@@ -0,0 +1,202 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import os
+import threading
+import time
+import uuid
+
+from utils import TEMP_PREFIX, atomic_write
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+LOCK_FILE = '.lock'
+
+
+class Spool(object):
+    """Durable on-disk queue of job collections waiting to be posted to Treeherder.
+
+    Entries are named after the time they were spooled, so listing the spool
+    directory in name order gives the order they have to be posted in. Entries
+    which failed too often are moved to the `failed` sub directory.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.failed_path = os.path.join(path, 'failed')
+
+    def _write(self, name, entry):
+        atomic_write(os.path.join(self.path, name), json.dumps(entry))
+
+    def put(self, treeherder_url, repository, guids, jobs):
+        """Add the jobs of a collection to the spool and return the name of the entry."""
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        name = '%017.6f-%s.json' % (time.time(), uuid.uuid4().hex)
+        self._write(name, {'treeherder_url': treeherder_url,
+                           'repository': repository,
+                           'guids': guids,
+                           'jobs': jobs,
+                           'attempts': 0,
+                           'not_before': 0})
+        return name
+
+    def entries(self):
+        if not os.path.isdir(self.path):
+            return []
+
+        return sorted(name for name in os.listdir(self.path)
+                      if name.endswith('.json') and not name.startswith(TEMP_PREFIX))
+
+    def read(self, name):
+        with open(os.path.join(self.path, name), 'r') as f:
+            return json.load(f)
+
+    def remove(self, name):
+        try:
+            os.remove(os.path.join(self.path, name))
+        except OSError:
+            # removed in the meantime, e.g. by a worker which didn't take the lock
+            if os.path.exists(os.path.join(self.path, name)):
+                raise
+
+    def retry(self, name, entry, delay):
+        entry['attempts'] += 1
+        entry['not_before'] = time.time() + delay
+        self._write(name, entry)
+
+    def lock(self):
+        """Return the locked lock file of the spool, or None if another worker holds it."""
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                # another process may have created it in the meantime
+                if not os.path.isdir(self.path):
+                    raise
+
+        f = open(os.path.join(self.path, LOCK_FILE), 'a')
+        if fcntl:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                f.close()
+                return None
+        return f
+
+    def fail(self, name):
+        if not os.path.isdir(self.failed_path):
+            os.makedirs(self.failed_path)
+        os.rename(os.path.join(self.path, name), os.path.join(self.failed_path, name))
+
+
+class SpoolWorker(object):
+    """Drain a spool by posting its entries with bounded concurrency.
+
+    Entries are posted in rounds of up to `concurrency` entries. An entry is
+    only picked once all earlier entries which share a job guid with it are
+    gone, so e.g. the completed state of a job is never posted before its
+    running state. Failed posts are retried with exponential backoff. Only a
+    single worker drains a spool at a time, which is ensured by a lock file.
+
+    """
+
+    def __init__(self, spool, post, concurrency, max_attempts, retry_delay, poll_interval):
+        self.spool = spool
+        self.post = post
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.poll_interval = poll_interval
+
+        self.posted = 0
+        self.retried = 0
+        self.failed = 0
+
+    def ready_entries(self):
+        now = time.time()
+        blocked = set()
+        ready = []
+
+        for name in self.spool.entries():
+            try:
+                entry = self.spool.read(name)
+            except (IOError, OSError, ValueError):
+                continue
+
+            guids = set(entry['guids'])
+            if (len(ready) < self.concurrency and not guids & blocked and
+                    entry['not_before'] <= now):
+                ready.append((name, entry))
+            blocked |= guids
+
+        return ready
+
+    def flush(self):
+        """Post one round of entries and return how many have been handled."""
+        ready = self.ready_entries()
+        errors = {}
+
+        def post(name, entry):
+            try:
+                self.post(entry)
+            except Exception as e:
+                errors[name] = e
+
+        threads = [threading.Thread(target=post, args=item) for item in ready]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for name, entry in ready:
+            if name not in errors:
+                self.spool.remove(name)
+                self.posted += 1
+            elif entry['attempts'] + 1 >= self.max_attempts:
+                print('Giving up on spooled entry %s: %s' % (name, errors[name]))
+                self.spool.fail(name)
+                self.failed += 1
+            else:
+                delay = self.retry_delay * 2 ** entry['attempts']
+                print('Failed to post spooled entry %s, retrying in %ds: %s' % (
+                    name, delay, errors[name]))
+                self.spool.retry(name, entry, delay)
+                self.retried += 1
+
+        return len(ready)
+
+    def run(self, once=False):
+        """Keep draining the spool, or until nothing is ready to be posted if `once` is set.
+
+        Returns whether the spool has been emptied, which is False if entries
+        are still waiting for a retry, or if another worker holds the lock.
+
+        """
+        lock = self.spool.lock()
+        if lock is None:
+            print('Another worker is already draining the spool %s' % self.spool.path)
+            return False
+
+        with lock:
+            reported = None
+            while True:
+                if not self.flush():
+                    counts = (self.posted, self.retried, self.failed)
+                    if counts != reported:
+                        print('Spool: %d posted, %d retried, %d failed' % counts)
+                        reported = counts
+
+                    if once:
+                        waiting = len(self.spool.entries())
+                        if waiting:
+                            print('Spool: %d entries are waiting for a retry' % waiting)
+                        return not waiting
+                    time.sleep(self.poll_interval)
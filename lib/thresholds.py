@@ -0,0 +1,109 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import os
+
+from history import series_key
+from utils import atomic_write
+
+# Scales the median absolute deviation to the standard deviation of normal data
+MAD_SCALE = 1.4826
+# Job statuses of the runs the thresholds are computed from
+PASSING_STATUSES = ('success',)
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+class DynamicThresholds(object):
+    """Acceptable maximum values computed from the recent runs in the result history.
+
+    The threshold of a series is the median of the values of the `window`
+    most recent passing runs, plus `mad_factor` times their
+    (scaled) median absolute deviation, which isn't thrown off by the odd
+    outlier. Failed runs are left out, so a regression doesn't raise the
+    threshold until it passes. Series with less than `min_runs` passing runs
+    have no threshold yet.
+
+    Thresholds are cached in the file at `path` together with the number of
+    runs they were computed from. A lookup is a dictionary lookup and a stat
+    of the series file, and only series which got new runs are recomputed,
+    from the last `window` passing runs only.
+
+    """
+
+    def __init__(self, history, path, metric, column, window, min_runs, mad_factor):
+        self.history = history
+        self.path = path
+        self.metric = metric
+        self.column = column
+        self.window = window
+        self.min_runs = min_runs
+        self.mad_factor = mad_factor
+
+        self._thresholds = None
+
+    @property
+    def thresholds(self):
+        if self._thresholds is None:
+            try:
+                with open(self.path, 'r') as f:
+                    self._thresholds = json.load(f)
+            except (IOError, ValueError):
+                self._thresholds = {}
+        return self._thresholds
+
+    def _save(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        try:
+            atomic_write(self.path, json.dumps(self.thresholds, indent=2, sort_keys=True))
+        except (IOError, OSError) as e:
+            # the thresholds get recomputed from the history next time
+            print('Failed to save the thresholds: %s' % e)
+
+    def compute(self, values):
+        if len(values) < self.min_runs:
+            return None
+
+        center = median(values)
+        mad = median([abs(value - center) for value in values])
+        return center + self.mad_factor * MAD_SCALE * mad
+
+    def _refresh(self, key):
+        count = self.history.count(*key)
+        cached = self.thresholds.get(series_key(*key))
+        if cached and cached['runs'] == count:
+            return cached, False
+
+        _, _, values = self.history.column(*key, metric=self.metric, column=self.column,
+                                           last=self.window, statuses=PASSING_STATUSES)
+        cached = {'runs': count, 'threshold': self.compute(values)}
+        self.thresholds[series_key(*key)] = cached
+        return cached, True
+
+    def get(self, test_type, device, memory, app):
+        """Return the threshold of a series, or None if it doesn't have enough runs."""
+        cached, changed = self._refresh((test_type, device, str(memory), app))
+        if changed:
+            self._save()
+        return cached['threshold']
+
+    def refresh(self):
+        """Bring the thresholds of all series up to date, and return them."""
+        changed = False
+        for key in self.history.series():
+            changed = self._refresh(key)[1] or changed
+        if changed:
+            self._save()
+
+        return dict((key, cached['threshold']) for key, cached in self.thresholds.items())
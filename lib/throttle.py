@@ -0,0 +1,111 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import random
+import threading
+import time
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, message):
+        Exception.__init__(self, 'CircuitOpenError: %s' % message)
+
+
+class Throttle(object):
+    """Rate limiting, retries and a circuit breaker for the requests to a service.
+
+    Requests are limited by a token bucket which refills at `rate` requests per
+    second up to `burst` tokens. Failures which `retry_delay` considers
+    transient are retried with jittered exponential backoff. After
+    `failure_threshold` consecutive transient failures the circuit opens, and
+    all requests fail right away until `reset_timeout` seconds have passed.
+
+    `retry_delay` gets the raised exception and returns None if the request
+    must not be retried, or the number of seconds the server asked us to wait
+    (0 if it didn't).
+
+    """
+
+    def __init__(self, retry_delay, rate, burst, max_attempts, backoff_base, backoff_max,
+                 failure_threshold, reset_timeout):
+        self.retry_delay = retry_delay
+        self.rate = rate
+        self.burst = burst
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self._lock = threading.Lock()
+        self._tokens = burst
+        self._updated = time.time()
+        self._failures = 0
+        self._opened_at = None
+
+        self.retries = 0
+        self.throttled = 0
+
+    def acquire(self):
+        """Take a token from the bucket, waiting until one is available."""
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+            # reserve the token right away, so concurrent callers queue up behind us
+            self._tokens -= 1
+            wait = -self._tokens / float(self.rate) if self._tokens < 0 else 0
+            if wait:
+                self.throttled += 1
+
+        if wait:
+            time.sleep(wait)
+
+    def check_circuit(self):
+        with self._lock:
+            if self._opened_at and time.time() - self._opened_at < self.reset_timeout:
+                raise CircuitOpenError('%d consecutive failures, not sending requests for %.1fs' % (
+                    self._failures, self.reset_timeout - (time.time() - self._opened_at)))
+
+    def _record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                self._opened_at = time.time()
+
+    def _record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def call(self, func, *args, **kwargs):
+        """Call `func` within the limits of the throttle, and return its result."""
+        attempt = 0
+        while True:
+            self.check_circuit()
+            self.acquire()
+
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                delay = self.retry_delay(e)
+                if delay is None:
+                    raise
+
+                self._record_failure()
+                attempt += 1
+                if attempt >= self.max_attempts:
+                    raise
+
+                backoff = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+                with self._lock:
+                    self.retries += 1
+                    if delay:
+                        self.throttled += 1
+
+                time.sleep(max(delay, random.uniform(backoff / 2.0, backoff)))
+            else:
+                self._record_success()
+                return result
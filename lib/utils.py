@@ -4,7 +4,9 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-import sys, os
+import sys, os, tempfile
+
+TEMP_PREFIX = '.tmp-'
 
 
 def getGeckoFromSources():
@@ -51,3 +53,26 @@ def getGeckoFromFile():
     sys.exit(-1)
 
   return gecko
+
+def atomic_write(path, data, mode=None):
+  """Replace the file at `path` with `data`, so readers never see a partial file.
+
+  The data is written to a temporary file next to `path`, whose name starts
+  with TEMP_PREFIX, and renamed over it. Windows can't rename over an existing
+  file, so there it gets removed first. With `mode` the permissions of the
+  file are set, otherwise it is only readable by the owner.
+
+  """
+  fd, temp_path = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=os.path.dirname(os.path.abspath(path)))
+  try:
+    with os.fdopen(fd, 'wb') as f:
+      f.write(data)
+    if mode is not None:
+      os.chmod(temp_path, mode)
+    if os.name == 'nt' and os.path.exists(path):
+      os.remove(path)
+    os.rename(temp_path, path)
+  except (IOError, OSError):
+    if os.path.exists(temp_path):
+      os.remove(temp_path)
+    raise
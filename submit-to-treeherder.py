@@ -8,14 +8,30 @@
 # https://github.com/mozilla/mozmill-ci/blob/master/jenkins-master/jobs/scripts/workspace/submission.py
 
 import argparse
+import json
+import mmap
+import multiprocessing
 import os
 import re
 import socket
+import sys
+import tempfile
+import threading
+import time
 from urlparse import urljoin, urlparse
 import uuid
 
 from config import config
 from lib import utils
+from lib.bootstrap import bootstrap_bound
+from lib.cache import RevisionHashCache
+from lib.history import ResultHistory
+from lib.pool import map_concurrently
+from lib.regressions import RegressionDetector
+from lib.report import TrendReport
+from lib.spool import Spool, SpoolWorker
+from lib.thresholds import DynamicThresholds, median
+from lib.throttle import Throttle
 
 import logging
 logging.basicConfig()
@@ -23,14 +39,42 @@ logging.basicConfig()
 here = os.path.dirname(os.path.abspath(__file__))
 
 RESULTSET_FRAGMENT = 'api/project/{repository}/resultset/?revision={revision}'
+RESULTSET_BATCH_FRAGMENT = 'api/project/{repository}/resultset/?revision__in={revisions}&count={count}'
 JOB_FRAGMENT = '/#/jobs?repo={repository}&revision={revision}'
 
+LOOKUP_HEADERS = {
+    'Accept': 'application/json',
+    'User-Agent': 'post-to-treeherder',
+}
+
+# Maximum number of revisions to resolve with a single resultset query
+RESULTSET_BATCH_SIZE = 50
+# Maximum number of jobs to post with a single job collection
+JOB_COLLECTION_SIZE = 50
+
+# Job guids of a --manifest run, keyed by test type and app name
+JOB_GUIDS_FILE = 'job_guids.json'
+
 BUILD_STATES = ['running', 'completed']
 
 RESULT_MARKER = 'visuallyLoaded'
+# Value columns of the Raptor summary table, following the 'Metric' column
+METRIC_COLUMNS = ('mean', 'median', 'min', 'max', 'stddev', 'bound_95')
+# Resamples used for the 95% bound of aggregated runs
+BOOTSTRAP_ITERATIONS = 10000
 ONE_DAY_MS = 86400000
 
+# Seconds between checks for new content when following a log
+FOLLOW_POLL_INTERVAL = 1
+# Default seconds without new log output after the results, after which following stops
+FOLLOW_SETTLE_TIME = 10
+
+# Initial number of bytes fetched from the end of archived logs
+ARCHIVE_TAIL_WINDOW = 64 * 1024
+
 COLD_LAUNCH = 'cold-launch'
+# Appended to the test type of the history series of aggregated runs
+AGGREGATED_SUFFIX = '-aggregated'
 
 
 class RaptorResultParser(object):
@@ -40,14 +84,25 @@ class RaptorResultParser(object):
     TESTFAILED = 'testfailed'
     UNKNOWN = 'unknown'
 
-    def __init__(self, retval, log_file, threshold):
+    def __init__(self, retval, log_file, threshold, tail_window=None, metrics_re=None,
+                 follow_timeout=None, aggregate=False, follow_settle=FOLLOW_SETTLE_TIME):
         self.retval = retval
-        self.log_file = log_file
+        # several logs can be given, e.g. of repeated runs on multiple devices
+        self.log_files = log_file if isinstance(log_file, list) else [log_file]
+        self.log_file = self.log_files[0]
+        self.aggregate = aggregate
+        self.tail_window = tail_window
+        self.follow_timeout = follow_timeout
+        self.follow_settle = follow_settle
         self.failure_re = re.compile(r'Aborted due to error')
         self.results_re = re.compile(r'^\| %s        \| \d' % RESULT_MARKER)
+        self.metrics_re = metrics_re
         self.threshold = float(threshold)
         self.failures = []
         self.result_line = []
+        self.metrics = []
+        self.bytes_scanned = 0
+        self.lines_scanned = 0
         self.parse_results()
 
     def parse_results(self):
@@ -56,43 +111,231 @@ class RaptorResultParser(object):
             print('Test was reported as busted (--test-failure)')
             return
 
-        # search the console log for raptor aborted error, if errors, mark as busted
+        for log_file in self.log_files:
+            # scan every log on its own, and add what was found to the previous logs
+            collected = (self.failures, self.result_line, self.metrics)
+            self.failures, self.result_line, self.metrics = [], [], []
+
+            self.log_file = log_file
+            scanned = self.scan_log()
+
+            self.failures = collected[0] + self.failures
+            self.result_line = collected[1] + self.result_line
+            self.metrics = collected[2] + self.metrics
+            if not scanned:
+                return
+
+        if self.aggregate:
+            self.aggregate_metrics()
+        self.evaluate()
+
+    def scan_log(self):
+        """Scan the current log file, and return False if it is missing."""
+        lines_scanned, bytes_scanned = self.lines_scanned, self.bytes_scanned
+
+        if self.follow_timeout:
+            print('Following log file: {}'.format(self.log_file))
+            if not self.follow():
+                print('Log file has not grown for %d seconds, giving up' % self.follow_timeout)
+
+            print('Scanned %d lines (%d bytes) of log file: %s' % (
+                self.lines_scanned - lines_scanned, self.bytes_scanned - bytes_scanned,
+                self.log_file))
+            return True
+
         try:
-            with open(self.log_file, 'r') as f:
-                for line in f.readlines():
-                    if self.failure_re.search(line):
-                        self.failures.append(line)
+            # the summary table is printed at the very end of the raptor run, so
+            # look there first and only read the whole log if it isn't found. The
+            # tables of all repeated runs are needed to aggregate them though.
+            if self.tail_window and not self.aggregate and self.parse_tail():
+                print('Found %s results within the last %d bytes of the log file' % (
+                    RESULT_MARKER, self.tail_window))
+            else:
+                if self.tail_window:
+                    print('%s results not found within the last %d bytes of the log file, '
+                          'falling back to a full scan' % (RESULT_MARKER, self.tail_window))
+                    self.failures = []
+                    self.result_line = []
+                    self.metrics = []
+                    self.lines_scanned, self.bytes_scanned = lines_scanned, bytes_scanned
+
+                # single streaming pass over the console log, looking for both raptor
+                # aborted errors and the raptor result value i.e. visuallyLoaded stat
+                with open(self.log_file, 'rb') as f:
+                    for line in f:
+                        self.scan_line(line)
         except IOError:
             print('Cannot look for failures due to missing log file: {}'.format(self.log_file))
             self.retval = 1
+            return False
 
-        if self.retval == 1 or self.failures:
-            return
+        print('Scanned %d lines (%d bytes) of log file: %s' % (
+            self.lines_scanned - lines_scanned, self.bytes_scanned - bytes_scanned,
+            self.log_file))
+        return True
+
+    def parse_tail(self):
+        """Search backwards from the end of the log for the summary table.
+
+        Lines are scanned from EOF until `tail_window` bytes are exhausted. Past
+        the summary table the rest of the window is still scanned, so a second
+        result row or an abort in it is noticed just like by a full scan.
+        Returns True if the result row was found.
+
+        """
+        with open(self.log_file, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if not size:
+                return False
+
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                floor = max(0, size - self.tail_window)
+                end = size
+                while end > floor:
+                    newline = mm.rfind('\n', floor, end - 1)
+                    if newline == -1 and floor:
+                        # line is cut off by the start of the window
+                        break
+                    start = newline + 1
+
+                    line = mm[start:end]
+                    end = start
+                    self.scan_line(line)
+            finally:
+                mm.close()
+
+        # restore the order in which the lines appear in the log
+        self.failures.reverse()
+        self.result_line.reverse()
+        self.metrics.reverse()
+
+        return bool(self.result_line)
+
+    def follow(self):
+        """Incrementally scan the log while raptor is still writing it, like `tail -F`.
+
+        The log may not exist yet, and is reopened if it gets rotated or truncated.
+        Returns True as soon as raptor aborted or the summary table is complete,
+        or once the results were found and the log has not grown for
+        `follow_settle` seconds, e.g. when the summary table is the end of the
+        log. Returns False if the log has not grown for `follow_timeout` seconds.
+
+        """
+        f = None
+        inode = None
+        pending = ''
+        last_change = time.time()
 
-        # raptor not aborted, so check actual raptor result value i.e. visuallyLoaded stat
         try:
-            with open(self.log_file, 'r') as f:
-                for line in f.readlines():
-                    if self.results_re.match(line):
-                        self.result_line.append(line)
+            while True:
+                if f is None:
+                    try:
+                        f = open(self.log_file, 'rb')
+                        inode = os.fstat(f.fileno()).st_ino
+                    except IOError:
+                        f = None
+
+                if f is not None:
+                    chunk = f.read(64 * 1024)
+                    if chunk:
+                        last_change = time.time()
+                        lines = (pending + chunk).split('\n')
+                        pending = lines.pop()
+                        for line in lines:
+                            self.scan_line(line + '\n')
+
+                            # abort early, or stop once we walked past the end of the summary table,
+                            # unless more tables of repeated runs are expected
+                            if self.failures or (self.result_line and not line.startswith('|') and
+                                                 not self.aggregate):
+                                return True
+                        continue
+
+                    try:
+                        stat = os.stat(self.log_file)
+                    except OSError:
+                        stat = None
+                    if stat is None or stat.st_ino != inode or stat.st_size < f.tell():
+                        f.close()
+                        f = None
+                        pending = ''
+
+                # the summary table may be the last output, or more runs may follow it
+                if self.result_line and time.time() - last_change > self.follow_settle:
+                    return True
+                if time.time() - last_change > self.follow_timeout:
+                    return False
+
+                time.sleep(FOLLOW_POLL_INTERVAL)
+        finally:
+            if f is not None:
+                f.close()
+
+    def scan_line(self, line):
+        self.lines_scanned += 1
+        self.bytes_scanned += len(line)
+
+        if self.failure_re.search(line):
+            self.failures.append(line)
+        if self.results_re.match(line):
+            self.result_line.append(line)
+        if self.metrics_re and self.metrics_re.match(line):
+            self.metrics.append(self.parse_metric_row(line))
+
+    def parse_metric_row(self, line):
+        """Convert a row of the summary table into a record of typed values."""
+        cells = [cell.strip() for cell in line.split('|')[1:-1]]
+        record = {'metric': cells[0]}
+        for column, value in zip(METRIC_COLUMNS, cells[1:]):
+            try:
+                record[column] = float(value)
+            except ValueError:
+                record[column] = None
+
+        return record
+
+    def aggregate_metrics(self):
+        """Combine the rows of repeated runs into a single row per metric, see `combine_runs`."""
+        rows = {}
+        for record in self.metrics:
+            rows.setdefault(record['metric'], []).append(record)
+
+        metrics = []
+        for record in self.metrics:
+            runs = rows.pop(record['metric'], None)
+            if runs is None:
+                continue
+            metrics.append(record if len(runs) == 1 else combine_runs(runs))
+
+        self.metrics = metrics
+
+    def evaluate(self):
+        # if raptor aborted with errors, mark as busted
+        if self.retval == 1 or self.failures:
+            return
 
-        except IOError:
+        if not self.result_line:
             print('Raptor "visuallyLoaded" results not found in log file: {}'.format(self.log_file))
             self.retval = 1
-
-        if not self.result_line or len(self.result_line) > 1: 
+        elif len(self.result_line) > 1 and not self.aggregate:
             self.retval = 1
         else:
             print('Found result line for %s:' % RESULT_MARKER)
             print self.result_line
-            x = self.result_line[0].split('|')
+            rows = [line.split('|') for line in self.result_line]
 
-            if len(x) != 9:
+            if any(len(x) != 9 for x in rows):
                 print("Unable to find a '95% Bound' value for " + RESULT_MARKER)
                 self.retval = 1
             else:
-                # want value in '95% Bound' column which is the last value in the row
-                result = float(x[7].strip())
+                if len(rows) == 1:
+                    # want value in '95% Bound' column which is the last value in the row
+                    result = float(rows[0][7].strip())
+                else:
+                    result = combine_runs([self.parse_metric_row(line)
+                                           for line in self.result_line])['bound_95']
+                    print('Aggregated %d runs' % len(rows))
                 print('%s: %.2f' % (RESULT_MARKER, result))
                 print('Acceptable max: %.2f' % self.threshold)
 
@@ -128,23 +371,107 @@ class RaptorResultParser(object):
         return failures
 
 
+def combine_runs(runs):
+    """Combine the summary table rows of repeated runs of a metric into one row.
+
+    The runs are weighted equally, and `runs` holds their number. The stddev
+    is the one of all runs pooled, i.e. the spread within the runs plus the
+    spread of their means. The 95% bound is bootstrapped from the means of the
+    runs, but is never less than the largest 95% bound of a single run, so a
+    noisy run can't be averaged away.
+
+    """
+    combined = dict.fromkeys(METRIC_COLUMNS)
+    combined.update({'metric': runs[0]['metric'], 'runs': len(runs)})
+
+    means = [run['mean'] for run in runs if run['mean'] is not None]
+    variances = [run['stddev'] ** 2 for run in runs if run['stddev'] is not None]
+    bounds = [run['bound_95'] for run in runs if run['bound_95'] is not None]
+    minimums = [run['min'] for run in runs if run['min'] is not None]
+    maximums = [run['max'] for run in runs if run['max'] is not None]
+    if means:
+        average = sum(means) / len(means)
+        within = sum(variances) / len(variances) if variances else 0.0
+        between = sum((mean - average) ** 2 for mean in means) / len(means)
+        combined.update({
+            'mean': average,
+            'median': median(means),
+            'stddev': (within + between) ** 0.5,
+            'bound_95': max([bootstrap_bound(means, BOOTSTRAP_ITERATIONS)] + bounds)
+        })
+    combined['min'] = min(minimums) if minimums else None
+    combined['max'] = max(maximums) if maximums else None
+    return combined
+
+
+def parse_archived_log(s3bucket, key_name, threshold, metrics_re=None, aggregate=False):
+    """Re-extract the results of a log archived in S3, fetching as little of it as possible.
+
+    Only the end of the log is fetched at first, and the window is doubled
+    until the result row or an abort has been found, or the log has been read
+    completely. Logs which have to be downloaded completely anyway to read
+    their end (see `S3Bucket.supports_tail`) are fetched in full right away.
+
+    """
+    # repeated runs can be anywhere in the log, so all of it is needed to aggregate them
+    if aggregate or not s3bucket.supports_tail(key_name):
+        window = sys.maxint
+    else:
+        window = ARCHIVE_TAIL_WINDOW
+
+    while True:
+        data, complete = s3bucket.read_tail(key_name, window)
+        if not complete:
+            # drop the line cut off by the start of the window
+            data = data[data.find('\n') + 1:]
+
+        with tempfile.NamedTemporaryFile(suffix='.log') as tf:
+            tf.write(data)
+            tf.flush()
+            parser = RaptorResultParser(0, tf.name, threshold, metrics_re=metrics_re,
+                                        aggregate=aggregate)
+
+        if complete or parser.failures or parser.result_line:
+            return parser
+
+        window *= 2
+
+
 class Submission(object):
 
     def __init__(self, repository, settings, app_name, test_type, start_time, finish_time, 
-                 test_busted, treeherder_url=None, treeherder_client_id=None, treeherder_secret=None):
+                 test_busted, treeherder_url=None, treeherder_client_id=None, treeherder_secret=None,
+                 tail_window=None, follow_timeout=None, spool=None, revision=None, device=None,
+                 memory=None, test_time=None, history=None, thresholds=None,
+                 regressions=None, log_files=None, aggregate=False, report=None,
+                 follow_settle=FOLLOW_SETTLE_TIME):
 
         self.repository = repository
-        self.revision = utils.getGeckoFromFile()
-        self.device = (os.environ['DEVICE_TYPE']).strip().lower()
-        self.memory = (os.environ['MEMORY']).strip()
+        self.revision = revision or utils.getGeckoFromFile()
+        self.device = (device or os.environ['DEVICE_TYPE']).strip().lower()
+        self.memory = (memory or os.environ['MEMORY']).strip()
+        self.test_time = test_time or os.environ['TEST_TIME']
         self.app_name = app_name
         self.test_type = test_type
         self.start_time = start_time
         self.finish_time = finish_time
         self.test_busted = test_busted
         self.settings = settings
+        self.tail_window = tail_window
+        self.follow_timeout = follow_timeout
+        self.follow_settle = follow_settle
+        self.spool = spool
+        self.history = history
+        self.thresholds = thresholds
+        self.regressions = regressions
+        self.log_files = log_files
+        self.aggregate = aggregate
+        self.report = report
+
+        self.revision_hash = None
 
         self._job_details = []
+        self._revision_cache = RevisionHashCache(**config['revision_hash_cache'])
 
         self.url = treeherder_url
         self.client_id = treeherder_client_id
@@ -209,7 +536,7 @@ class Submission(object):
             job.add_job_symbol(self.settings['treeherder']['job_symbol'].format(**kwargs))
 
         # request time will be the jenkins TEST_TIME i.e. when jenkins job started
-        job.add_submit_timestamp(int(os.environ['TEST_TIME']))
+        job.add_submit_timestamp(int(self.test_time))
 
         # test start time for that paraticular app is set in jenkins job itself
         job.add_start_timestamp(int(self.start_time))
@@ -223,41 +550,40 @@ class Submission(object):
         if not self.url:
             raise ValueError('URL for Treeherder is missing.')
 
+        # already resolved, e.g. by resolve_revision_hashes()
+        if self.revision_hash:
+            return self.revision_hash
+
+        revision_hash = self._revision_cache.get(self.url, self.repository, self.revision)
+        if not revision_hash:
+            revision_hash = self.lookup_revision_hash()
+            self._revision_cache.set(self.url, self.repository, self.revision, revision_hash)
+
+        print('Revision hash cache: %d hits, %d misses' % (self._revision_cache.hits,
+                                                           self._revision_cache.misses))
+        self.revision_hash = revision_hash
+        return revision_hash
+
+    def lookup_revision_hash(self):
         lookup_url = urljoin(self.url,
                              RESULTSET_FRAGMENT.format(repository=self.repository,
                                                        revision=self.revision))
-        headers = {
-            'Accept': 'application/json',
-            'User-Agent': 'post-to-treeherder',
-        }
 
         print('Getting revision hash from: {}'.format(lookup_url))
-        response = requests.get(lookup_url, headers=headers)
-        response.raise_for_status()
+        resultset = get_throttle().call(fetch_json, lookup_url)
 
-        if not response.json():
+        if not resultset:
             raise ValueError('Unable to determine revision hash for {}. '
                              'Perhaps it has not been ingested by '
                              'Treeherder?'.format(self.revision))
 
-        return response.json()['results'][0]['revision_hash']
+        return resultset['results'][0]['revision_hash']
 
     def submit(self, job, logs=None):
         logs = logs or []
 
-        # We can only submit job info once, so it has to be done in completed
-        if self._job_details:
-            job.add_artifact('Job Info', 'json', {'job_details': self._job_details})
-
-        job_collection = TreeherderJobCollection()
-        job_collection.add(job)
-
-        print('Sending results to Treeherder: {}'.format(job_collection.to_json()))
-        url = urlparse(self.url)
-       
-        client = TreeherderClient(protocol=url.scheme, host=url.hostname,
-                                  client_id=self.client_id, secret=self.secret)
-        client.post_collection(self.repository, job_collection)
+        post_jobs(self.url, self.client_id, self.secret, self.repository, [job],
+                  spool=self.spool)
 
         print('Results are available to view at: {}'.format(
             urljoin(self.url,
@@ -267,12 +593,68 @@ class Submission(object):
         job.add_state('running')
         self.submit(job)
 
+    @property
+    def series(self):
+        # aggregated runs are a different statistic, so they don't share a series with single runs
+        test_type = self.test_type + AGGREGATED_SUFFIX if self.aggregate else self.test_type
+        return (test_type, self.device, self.memory, self.app_name)
+
+    def record_history(self, parser):
+        # keep the results in the local history, so trends can be looked at later
+        test_type, device, memory, app = self.series
+        try:
+            self.history.append(test_type, device, memory, app,
+                                self.start_time, self.revision, parser.metrics,
+                                names=self.settings['metrics'], status=parser.status)
+        except (IOError, OSError) as e:
+            print('Failed to add the results to the history: %s' % e)
+
+    def add_regression_details(self, regressions):
+        # all series are checked in one go, but only the regression of this job's series is shown
+        for regression in regressions:
+            if tuple(regression['series']) == self.series:
+                print('Regression since revision %s: %.2f -> %.2f' % (
+                    regression['revision'], regression['before'], regression['after']))
+                self._job_details.append({
+                    'title': 'Possible regression',
+                    'value': '%s %+.1f%% (%.2f -> %.2f) since revision %s' % (
+                        self.regressions.metric, regression['change'] * 100,
+                        regression['before'], regression['after'], regression['revision']),
+                    'content_type': 'text'
+                })
+
+    def add_trend_report(self):
+        # a small chart of the recent results, which doesn't need the VPN like the dashboard
+        settings = config['reports']
+        key = self.series
+        start = int(self.start_time) - settings['days'] * 86400
+        try:
+            name = self.report.write_series(settings['path'], key, start=start,
+                                            threshold=self.threshold)
+            print('Trend report: %s' % os.path.join(settings['path'], name))
+        except (IOError, OSError) as e:
+            print('Failed to write the trend report: %s' % e)
+
+        self._job_details.append({
+            'title': 'Raptor trend (%d days)' % settings['days'],
+            'value': self.report.svg(*key, start=start, threshold=self.threshold),
+            'content_type': 'raw_html'
+        })
+
     def get_threshold(self):
         # get the acceptable maximum value for the corresponding test, & device (including memory)
         if self.test_type == COLD_LAUNCH:
-            return self.settings['thresholds'][self.device][self.memory][self.app_name]
+            threshold = self.settings['thresholds'][self.device][self.memory][self.app_name]
         else:
-            return self.settings['thresholds'][self.device][self.memory]['homescreen']
+            threshold = self.settings['thresholds'][self.device][self.memory]['homescreen']
+
+        # the threshold computed from the recent results may only be stricter
+        if self.thresholds:
+            dynamic = self.thresholds.get(*self.series)
+            if dynamic is not None:
+                return min(dynamic, threshold)
+
+        return threshold
 
     def build_dashboard_url(self):
         # build raptor dashboard url for given device, branch, memory etc.
@@ -285,7 +667,7 @@ class Submission(object):
         dash_branch = "&var-branch=master"
         dash_test = "&var-test=%s" % self.test_type
 
-        test_time =  int(os.environ['TEST_TIME'])
+        test_time =  int(self.test_time)
         from_time = test_time - (ONE_DAY_MS * 2)
         to_time = test_time + (ONE_DAY_MS * 2)
         dash_from = "&from=%d" % from_time
@@ -310,19 +692,70 @@ class Submission(object):
     def submit_completed_job(self, job, retval):
         """Update the status of a job to completed.
         """
+        self.complete_job(job, retval)
+        self.submit(job)
+
+    def collect_results(self, retval, parser=None):
+        """Parse the log of the test, unless a parser is given, and keep the results.
+
+        Returns the parser, to complete the job with once the results of all
+        jobs of a batch are in the history.
+        """
         # Retrieve acceptable threshold
         self.threshold = self.get_threshold()
 
         # Parse results log
-        if self.test_type == COLD_LAUNCH:
+        if parser is None and self.log_files:
+            parser = RaptorResultParser(retval, self.log_files,
+                self.threshold, tail_window=self.tail_window, metrics_re=self.settings['metrics_re'],
+                follow_timeout=self.follow_timeout, aggregate=self.aggregate,
+                follow_settle=self.follow_settle)
+        elif parser is None and self.test_type == COLD_LAUNCH:
             parser = RaptorResultParser(retval, self.settings['logs'][self.app_name].format(**kwargs), 
-                self.threshold)
-        else:
+                self.threshold, tail_window=self.tail_window, metrics_re=self.settings['metrics_re'],
+                follow_timeout=self.follow_timeout, aggregate=self.aggregate,
+                follow_settle=self.follow_settle)
+        elif parser is None:
             parser = RaptorResultParser(retval, self.settings['logs']['reboot'].format(**kwargs), 
-                self.threshold)
+                self.threshold, tail_window=self.tail_window, metrics_re=self.settings['metrics_re'],
+                follow_timeout=self.follow_timeout, aggregate=self.aggregate,
+                follow_settle=self.follow_settle)
+
+        if parser.metrics and self.history:
+            self.record_history(parser)
+        return parser
+
+    def complete_job(self, job, retval, parser=None, regressions=None):
+        """Add the results and the completed state to a job, without submitting it.
+
+        If no parser from `collect_results` is given, the log of the test gets
+        parsed. `regressions` are the regressions detected in the history after
+        the results of the batch were added; without them the history is
+        checked for this job alone.
+        """
+        if parser is None:
+            parser = self.collect_results(retval)
 
         job.add_result(parser.status)
 
+        # Attach all rows of the summary table, so they don't have to be grepped from the logs
+        if parser.metrics:
+            job.add_artifact('Raptor Metrics', 'json', {
+                'test_type': self.test_type,
+                'app_name': self.app_name,
+                'device': self.device,
+                'memory': self.memory,
+                'revision': self.revision,
+                'metrics': parser.metrics
+            })
+
+            if self.regressions:
+                if regressions is None:
+                    regressions = detect_regressions()
+                self.add_regression_details(regressions)
+            if self.report:
+                self.add_trend_report()
+
         # If the Jenkins BUILD_URL environment variable is present add it as artifact
         if os.environ.get('BUILD_URL'):
             self._job_details.append({
@@ -342,9 +775,277 @@ class Submission(object):
         })
 
         job.add_state('completed')
-        job.add_end_timestamp(int(self.finish_time))
+        # when following the log the test may still be running, so there is no finish time yet
+        job.add_end_timestamp(int(self.finish_time or time.time()))
+
+        # We can only submit job info once, so it has to be done in completed
+        job.add_artifact('Job Info', 'json', {'job_details': self._job_details})
+
+
+# Guards the lazy creation of the objects shared by concurrent requests
+_shared_lock = threading.RLock()
+_http_session = None
+_throttle = None
+_treeherder_clients = {}
+_history = None
+_thresholds = None
+_regression_detector = None
+_trend_report = None
+
+
+def get_http_session():
+    """Return the HTTP session shared by all Treeherder traffic of this process."""
+    global _http_session
+    with _shared_lock:
+        if _http_session is None:
+            _http_session = PooledSession(**config['http'])
+
+    return _http_session
+
+
+def get_history():
+    """Return the local result history shared by all submissions of this process."""
+    global _history
+    with _shared_lock:
+        if _history is None:
+            _history = ResultHistory(**config['history'])
+
+    return _history
+
+
+def get_thresholds():
+    """Return the dynamic thresholds shared by all submissions, or None if disabled."""
+    global _thresholds
+    settings = config['dynamic_thresholds']
+    with _shared_lock:
+        if _thresholds is None and settings['enabled']:
+            _thresholds = DynamicThresholds(get_history(), settings['path'], RESULT_MARKER,
+                                            'bound_95', settings['window'],
+                                            settings['min_runs'], settings['mad_factor'])
+
+    return _thresholds
+
+
+def get_regression_detector():
+    """Return the regression detector shared by all submissions, or None if unavailable."""
+    global _regression_detector
+    settings = config['regressions']
+    with _shared_lock:
+        if _regression_detector is None and settings['enabled']:
+            _regression_detector = RegressionDetector(get_history(), RESULT_MARKER, 'bound_95',
+                                                      settings['window'], settings['min_segment'],
+                                                      settings['t_threshold'],
+                                                      settings['min_change'])
+            if not _regression_detector.available:
+                print('numpy is not installed, regressions will not be detected')
+
+    if _regression_detector and _regression_detector.available:
+        return _regression_detector
+    return None
+
+
+def detect_regressions():
+    """Check all series of the history for regressions at once, or return None if unavailable.
+
+    The detector reads every series, so a batch of jobs should only run it
+    once, after the results of all its jobs were added to the history.
+
+    """
+    detector = get_regression_detector()
+    if not detector:
+        return None
+
+    regressions = detector.detect()
+    print('Regressions detected in %d series' % len(regressions))
+    return regressions
+
+
+def get_trend_report():
+    """Return the trend report writer shared by all submissions, or None if disabled."""
+    global _trend_report
+    settings = config['reports']
+    with _shared_lock:
+        if _trend_report is None and settings['enabled']:
+            _trend_report = TrendReport(get_history(), RESULT_MARKER, 'bound_95',
+                                        settings['points'])
+
+    return _trend_report
+
+
+def treeherder_retry_delay(e):
+    """Return how long to wait before retrying a failed Treeherder request.
+
+    Only throttling, server errors and connection problems are retried, for
+    everything else None is returned.
+
+    """
+    if isinstance(e, requests.exceptions.HTTPError):
+        if e.response is None:
+            return 0
+        if e.response.status_code == 429 or e.response.status_code >= 500:
+            try:
+                return float(e.response.headers.get('Retry-After', 0))
+            except ValueError:
+                return 0
+        return None
+
+    if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return 0
+
+    return None
+
+
+def get_throttle():
+    """Return the throttle shared by all Treeherder requests of this process."""
+    global _throttle
+    with _shared_lock:
+        if _throttle is None:
+            _throttle = Throttle(treeherder_retry_delay, **config['throttle'])
+
+    return _throttle
+
+
+def fetch_json(url):
+    response = get_http_session().get(url, headers=LOOKUP_HEADERS)
+    response.raise_for_status()
+
+    return response.json()
+
+
+def get_treeherder_client(treeherder_url, client_id, secret):
+    """Return a Treeherder client which reuses the connections of the shared session."""
+    key = (treeherder_url, client_id)
+    with _shared_lock:
+        if key not in _treeherder_clients:
+            url = urlparse(treeherder_url)
+            client = TreeherderClient(protocol=url.scheme, host=url.hostname,
+                                      client_id=client_id, secret=secret)
+
+            # treeherder-client keeps its own session, so hand it our connection pool
+            if hasattr(client, 'session'):
+                get_http_session().share_with(client.session)
+            if hasattr(client, 'timeout'):
+                client.timeout = get_http_session().timeout
+
+            _treeherder_clients[key] = client
+
+    return _treeherder_clients[key]
+
+
+def post_jobs(treeherder_url, client_id, secret, repository, jobs, spool=None, concurrency=1):
+    """Post jobs to Treeherder, with up to JOB_COLLECTION_SIZE jobs per collection.
+
+    Up to `concurrency` collections are posted at the same time. If a spool is
+    given the collections are only written to it, and get posted later by the
+    worker started with --flush-spool.
+
+    """
+    job_collections = []
+    for i in range(0, len(jobs), JOB_COLLECTION_SIZE):
+        job_collection = TreeherderJobCollection()
+        for job in jobs[i:i + JOB_COLLECTION_SIZE]:
+            job_collection.add(job)
+        job_collections.append(job_collection)
+
+    def post(job_collection):
+        if spool:
+            name = spool.put(treeherder_url, repository,
+                             [job.data['job']['job_guid'] for job in job_collection.data],
+                             [job.data for job in job_collection.data])
+            print('Spooled results for Treeherder: {}'.format(name))
+        else:
+            print('Sending results to Treeherder: {}'.format(job_collection.to_json()))
+            client = get_treeherder_client(treeherder_url, client_id, secret)
+            get_throttle().call(client.post_collection, repository, job_collection)
+
+    map_concurrently(post, job_collections, concurrency)
+
+
+def flush_spool(kwargs):
+    """Keep posting the job collections written to the spool by other runs.
+
+    Returns the exit status, which with --once is 1 if not all of them could
+    be posted yet.
+
+    """
+    def post(entry):
+        job_collection = TreeherderJobCollection()
+        for data in entry['jobs']:
+            job_collection.add(TreeherderJob(data))
+
+        client = get_treeherder_client(entry['treeherder_url'], kwargs['treeherder_client_id'],
+                                       kwargs['treeherder_secret'])
+        get_throttle().call(client.post_collection, entry['repository'], job_collection)
+
+    worker = SpoolWorker(Spool(kwargs['spool']), post, **config['spool'])
+    return 0 if worker.run(once=kwargs['once']) else 1
+
+
+def resolve_revision_hashes(submissions, concurrency=1, strict=True):
+    """Resolve the revision hashes of many submissions at once.
+
+    Cached revisions are taken from the cache, and all remaining distinct
+    revisions are looked up with as few resultset queries as possible, up to
+    `concurrency` of them at the same time. Revisions unknown to Treeherder
+    raise a ValueError, or are returned if `strict` is not set.
+
+    """
+    pending = {}
+    for submission in submissions:
+        if submission.revision_hash:
+            continue
+
+        revision_hash = submission._revision_cache.get(submission.url, submission.repository,
+                                                       submission.revision)
+        if revision_hash:
+            submission.revision_hash = revision_hash
+        else:
+            revisions = pending.setdefault((submission.url, submission.repository), {})
+            revisions.setdefault(submission.revision, []).append(submission)
+
+    batches = []
+    for (url, repository), revisions in pending.items():
+        if not url:
+            raise ValueError('URL for Treeherder is missing.')
+
+        pending_revisions = sorted(revisions.keys())
+        for i in range(0, len(pending_revisions), RESULTSET_BATCH_SIZE):
+            batches.append((url, repository, pending_revisions[i:i + RESULTSET_BATCH_SIZE]))
+
+    def lookup(item):
+        url, repository, batch = item
+        lookup_url = urljoin(url, RESULTSET_BATCH_FRAGMENT.format(repository=repository,
+                                                                  revisions=','.join(batch),
+                                                                  count=len(batch)))
+
+        print('Getting %d revision hashes from: %s' % (len(batch), lookup_url))
+        return get_throttle().call(fetch_json, lookup_url)
+
+    resultsets = map_concurrently(lookup, batches, concurrency)
+
+    for (url, repository, batch), resultset in zip(batches, resultsets):
+        revisions = pending[(url, repository)]
+        for result in resultset.get('results', []):
+            for revision in batch:
+                # Treeherder may know the full or the short form of the revision
+                if not (result['revision'].startswith(revision) or
+                        revision.startswith(result['revision'])):
+                    continue
+
+                for submission in revisions[revision]:
+                    submission.revision_hash = result['revision_hash']
+                revisions[revision][0]._revision_cache.set(url, repository, revision,
+                                                           result['revision_hash'])
+
+    unresolved = set(submission.revision for submission in submissions
+                     if not submission.revision_hash)
+    if unresolved and not strict:
+        return sorted(unresolved)
+    if unresolved:
+        raise ValueError('Unable to determine revision hash for {}. '
+                         'Perhaps it has not been ingested by '
+                         'Treeherder?'.format(', '.join(sorted(unresolved))))
 
-        self.submit(job)
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -353,22 +1054,55 @@ def parse_args():
                         help='The app name i.e. "clock"')
     parser.add_argument('--test-type',
                         choices=config['test_types'].keys(),
-                        required=True,
                         help='The name of the Raptor test for building the job name.')
     parser.add_argument('--start-time',
-                        required=True,
                         help='The time (epoch) that the test started at.')
     parser.add_argument('--finish-time',
                         help='The time (epoch) that the test finished at.')
     parser.add_argument('--test-failure',
                         help='(Bool) Set to 1 if the test failed to run on Jenkins (busted).')
     parser.add_argument('--repository',
-                        required=True,
                         help='The repository name the build was created from.')
     parser.add_argument('--build-state',
                         choices=BUILD_STATES,
-                        required=True,
                         help='The state of the build')
+    parser.add_argument('--tail-window',
+                        type=int,
+                        help='Only search the last TAIL_WINDOW bytes of the log for the results, '
+                             'falling back to a full scan if they are not found there. Result '
+                             'rows and aborts before the window are not seen.')
+    parser.add_argument('--follow',
+                        action='store_true',
+                        help='Follow the log while the test is still running and submit the '
+                             'completed job as soon as raptor aborted or the results are found.')
+    parser.add_argument('--follow-timeout',
+                        type=int,
+                        default=600,
+                        help='Seconds without new log output after which --follow gives up.')
+    parser.add_argument('--follow-settle',
+                        type=int,
+                        default=FOLLOW_SETTLE_TIME,
+                        help='Seconds without new log output after the results were found, '
+                             'after which --follow stops. With --aggregate it has to be longer '
+                             'than the pause between the repeated runs.')
+    parser.add_argument('--log-file',
+                        action='append',
+                        help='Log file of the test, instead of the configured one. Can be given '
+                             'several times together with --aggregate.')
+    parser.add_argument('--aggregate',
+                        action='store_true',
+                        help='Combine the results of repeated runs, found in one or more log '
+                             'files, instead of marking the job as busted. Their 95%% bound is '
+                             'bootstrapped, but never less than the one of any single run. The '
+                             'results are kept in their own history series.')
+    parser.add_argument('--manifest',
+                        help='JSON file with a list of jobs to submit at once. Each entry has '
+                             'the keys "app_name", "test_type", "start_time", "finish_time" '
+                             'and "test_failure", which override the command line arguments.')
+    parser.add_argument('--concurrency',
+                        type=int,
+                        default=8,
+                        help='Maximum number of concurrent lookups and posts for --manifest.')
 
     aws_group = parser.add_argument_group('AWS', 'Arguments for Amazon S3')
     aws_group.add_argument('--aws-bucket',
@@ -392,37 +1126,92 @@ def parse_args():
                                   default=os.environ.get('RAPTOR_TREEHERDER_SECRET'),
                                   help='Secret for submission to Treeherder.')
 
-    return vars(parser.parse_args())
-
-
-if __name__ == '__main__':
-    print('Raptor Treeherder Submission Script Version %s' % config['version'])
-    kwargs = parse_args()
-
-    # app-name required if test-type is coldlaunch
-    if kwargs['test_type'] == COLD_LAUNCH:
-        if not kwargs['app_name']:
-            print('--app-name argument required when --test-type=cold-launch')
-            exit(1)
-
-    # Can only be imported after the environment has been activated
-    import mozinfo
-    import requests
-
-    from thclient import TreeherderClient, TreeherderJob, TreeherderJobCollection
-
-    settings = config['test_types'][kwargs['test_type']]
-
-    th = Submission(kwargs['repository'],
-                    treeherder_url=kwargs['treeherder_url'],
-                    treeherder_client_id=kwargs['treeherder_client_id'],
-                    treeherder_secret=kwargs['treeherder_secret'],
-                    settings=settings,
-                    app_name=kwargs['app_name'],
-                    test_type=kwargs['test_type'],
-                    start_time=kwargs['start_time'],
-                    finish_time=kwargs['finish_time'],
-                    test_busted=kwargs['test_failure'])
+    backfill_group = parser.add_argument_group('backfill', 'Arguments for backfilling results')
+    backfill_group.add_argument('--backfill',
+                                nargs='?',
+                                const='',
+                                help='Re-submit the results of the logs archived in --aws-bucket '
+                                     'whose keys match the given pattern, or the key_pattern '
+                                     'of the backfill settings.')
+    backfill_group.add_argument('--backfill-checkpoint',
+                                default='backfill-checkpoint.json',
+                                help='File recording the logs which have been backfilled, and '
+                                     'those skipped because Treeherder does not know their '
+                                     'revision.')
+
+    spool_group = parser.add_argument_group('spool', 'Arguments for spooling submissions')
+    spool_group.add_argument('--spool',
+                             help='Directory to spool job collections to instead of posting '
+                                  'them to Treeherder.')
+    spool_group.add_argument('--flush-spool',
+                             action='store_true',
+                             help='Run the worker which posts the job collections in --spool.')
+    spool_group.add_argument('--once',
+                             action='store_true',
+                             help='Stop --flush-spool once nothing is ready to be posted. Exits '
+                                  'with status 1 if entries are left which wait for a retry, or '
+                                  'if another worker is draining the spool.')
+
+    args = parser.parse_args()
+
+    if args.flush_spool:
+        if not args.spool:
+            parser.error('--flush-spool requires --spool')
+        return vars(args)
+
+    if args.backfill is not None:
+        if not args.repository or not args.aws_bucket:
+            parser.error('--backfill requires --repository and --aws-bucket')
+        return vars(args)
+
+    if not args.repository or not args.build_state:
+        parser.error('--repository and --build-state are required')
+    if not args.manifest and (not args.test_type or not args.start_time):
+        parser.error('--test-type and --start-time are required without --manifest')
+
+    return vars(args)
+
+
+def create_submission(options):
+    return Submission(options['repository'],
+                      treeherder_url=options['treeherder_url'],
+                      treeherder_client_id=options['treeherder_client_id'],
+                      treeherder_secret=options['treeherder_secret'],
+                      settings=config['test_types'][options['test_type']],
+                      app_name=options['app_name'],
+                      test_type=options['test_type'],
+                      start_time=options['start_time'],
+                      finish_time=options['finish_time'],
+                      test_busted=options['test_failure'],
+                      tail_window=options['tail_window'],
+                      follow_timeout=options['follow_timeout'] if options['follow'] else None,
+                      spool=Spool(options['spool']) if options['spool'] else None,
+                      revision=options.get('revision'),
+                      device=options.get('device'),
+                      memory=options.get('memory'),
+                      test_time=options.get('test_time'),
+                      history=get_history(),
+                      thresholds=get_thresholds(),
+                      regressions=get_regression_detector(),
+                      log_files=options.get('log_file'),
+                      aggregate=options.get('aggregate', False),
+                      report=get_trend_report(),
+                      follow_settle=options['follow_settle'])
+
+
+def get_retval(test_failure):
+    # return value from jenkins test (--test-failure) indicates if busted
+    retval = 0
+    if test_failure != None:
+        if int(test_failure) != 0:
+            retval = 1
+
+    return retval
+
+
+def submit_job(kwargs):
+    """Submit the running or completed state of a single job."""
+    th = create_submission(kwargs)
 
     # State 'running'
     if kwargs['build_state'] == BUILD_STATES[0]:
@@ -441,12 +1230,281 @@ if __name__ == '__main__':
         except:
             job_guid = str(uuid.uuid4())
 
-        # return value from jenkins test (--test-failure) indicates if busted
-        retval = 0
-        if kwargs['test_failure'] != None:
-            if int(kwargs['test_failure']) != 0:
-                retval = 1
+        retval = get_retval(kwargs['test_failure'])
 
         job = th.create_job(job_guid, **kwargs)
 
         th.submit_completed_job(job, retval)
+
+
+def submit_manifest(kwargs):
+    """Create the jobs for all entries of the manifest and post them together."""
+    with open(kwargs['manifest'], 'r') as f:
+        entries = json.load(f)
+
+    submissions = []
+    for entry in entries:
+        options = dict(kwargs)
+        options.update(entry)
+        options.setdefault('app_name', None)
+
+        if options['test_type'] == COLD_LAUNCH and not options['app_name']:
+            raise ValueError('app_name required for cold-launch entries in {}'.format(
+                kwargs['manifest']))
+
+        submissions.append((create_submission(options), options))
+
+    # Look up all revision hashes at once, before any job gets created
+    resolve_revision_hashes([submission for submission, _ in submissions],
+                            concurrency=kwargs['concurrency'])
+
+    job_guids = {}
+    if kwargs['build_state'] == BUILD_STATES[1]:
+        # Read in job guids to update the reports
+        try:
+            with open(JOB_GUIDS_FILE, 'r') as f:
+                job_guids = json.load(f)
+        except (IOError, ValueError):
+            pass
+
+    for submission, options in submissions:
+        # entries can override the device and memory, which make separate jobs
+        key = '{}/{}/{}/{}'.format(options['test_type'], submission.device, submission.memory,
+                                   options['app_name'])
+        options['job_guid'] = job_guids.setdefault(key, str(uuid.uuid4()))
+
+    parsers = [None] * len(submissions)
+    regressions = None
+    if kwargs['build_state'] != BUILD_STATES[0]:
+        def collect_results(item):
+            submission, options = item
+            return submission.collect_results(get_retval(options['test_failure']))
+
+        # Parsing the logs of completed jobs can take a while, so do that concurrently too
+        parsers = map_concurrently(collect_results, submissions, kwargs['concurrency'])
+        regressions = detect_regressions()
+
+    def build_job(item):
+        (submission, options), parser = item
+        job = submission.create_job(options['job_guid'], **options)
+        if kwargs['build_state'] == BUILD_STATES[0]:
+            job.add_state('running')
+        else:
+            submission.complete_job(job, parser.retval, parser=parser, regressions=regressions)
+        return job
+
+    jobs = map_concurrently(build_job, zip(submissions, parsers), kwargs['concurrency'])
+
+    post_jobs(kwargs['treeherder_url'], kwargs['treeherder_client_id'],
+              kwargs['treeherder_secret'], kwargs['repository'], jobs,
+              spool=Spool(kwargs['spool']) if kwargs['spool'] else None,
+              concurrency=kwargs['concurrency'])
+
+    if kwargs['build_state'] == BUILD_STATES[0]:
+        utils.atomic_write(JOB_GUIDS_FILE, json.dumps(job_guids))
+
+    print('Submitted %d jobs in %d collections' % (
+        len(jobs), (len(jobs) + JOB_COLLECTION_SIZE - 1) // JOB_COLLECTION_SIZE))
+
+
+_backfill_bucket = None
+
+
+def init_backfill_worker(bucket_name, access_key_id, access_secret_key):
+    global _backfill_bucket
+
+    # every worker process needs its own S3 connection
+    _backfill_bucket = S3Bucket(bucket_name, access_key_id, access_secret_key)
+
+
+def parse_backfill_log(item):
+    key_name, test_type, threshold, aggregate = item
+    try:
+        parser = parse_archived_log(_backfill_bucket, key_name, threshold,
+                                    metrics_re=config['test_types'][test_type]['metrics_re'],
+                                    aggregate=aggregate)
+        return key_name, parser, None
+    except Exception as e:
+        return key_name, None, str(e)
+
+
+def backfill(kwargs):
+    """Re-submit the results of archived logs to Treeherder.
+
+    Logs are listed from the S3 bucket and parsed on a pool of processes. The
+    names of the archived logs have to match the `key_pattern` of the backfill
+    settings, whose named groups provide the test type, device, memory,
+    revision, start time and app name. Jobs are submitted in batches, after
+    which the processed logs are recorded in the checkpoint file, so an
+    interrupted backfill continues where it stopped.
+
+    Logs of revisions Treeherder doesn't know (anymore) are skipped, and
+    recorded as unresolved in the checkpoint file. Logs of a test type,
+    device, memory or app without thresholds in the configuration are
+    recorded as unsupported. Both are retried once they are removed from it.
+
+    """
+    settings = config['backfill']
+    key_pattern = re.compile(kwargs['backfill'] or settings['key_pattern'])
+    checkpoint = kwargs['backfill_checkpoint']
+
+    done = set()
+    unresolved = set()
+    unsupported = set()
+    if os.path.exists(checkpoint):
+        with open(checkpoint, 'r') as f:
+            state = json.load(f)
+        done = set(state['done'])
+        unresolved = set(state['unresolved'])
+        unsupported = set(state.get('unsupported', []))
+
+    def save_checkpoint():
+        utils.atomic_write(checkpoint, json.dumps({'done': sorted(done),
+                                                   'unresolved': sorted(unresolved),
+                                                   'unsupported': sorted(unsupported)}))
+
+    # fork the workers before the parent opens a connection they could inherit
+    pool = multiprocessing.Pool(settings['workers'], init_backfill_worker,
+                                (kwargs['aws_bucket'], kwargs['aws_key'], kwargs['aws_secret']))
+
+    s3bucket = S3Bucket(kwargs['aws_bucket'], kwargs['aws_key'], kwargs['aws_secret'])
+    submissions = {}
+    items = []
+    skipped = len(unsupported)
+    for key in s3bucket.ls(key_pattern):
+        if key.name in done or key.name in unresolved or key.name in unsupported:
+            continue
+
+        options = dict(kwargs)
+        options.update(key_pattern.match(key.name).groupdict())
+        options['test_time'] = options['start_time']
+        options['finish_time'] = options['start_time']
+        # only the logs of runs which finished are archived
+        options['test_failure'] = 0
+        try:
+            submission = create_submission(options)
+            threshold = submission.get_threshold()
+        except KeyError as e:
+            print('Skipping %s, %s is not in the configuration' % (key.name, e))
+            unsupported.add(key.name)
+            continue
+
+        submissions[key.name] = (submission, options)
+        items.append((key.name, options['test_type'], threshold, kwargs['aggregate']))
+
+    if len(unsupported) > skipped:
+        save_checkpoint()
+
+    print('Backfilling %d logs, %d already done, %d with unknown revisions, %d unsupported' % (
+        len(submissions), len(done), len(unresolved), len(unsupported)))
+    items.sort()
+
+    start = time.time()
+    parsed = 0
+    submitted = 0
+    batch = []
+
+    def submit_batch():
+        unknown = resolve_revision_hashes([submission for submission, _, _ in batch],
+                                          concurrency=kwargs['concurrency'], strict=False)
+        if unknown:
+            print('Skipping the logs of revisions unknown to Treeherder: %s' % ', '.join(unknown))
+
+        resolved = []
+        for submission, options, parser in batch:
+            if not submission.revision_hash:
+                unresolved.add(options['key_name'])
+                continue
+
+            submission.collect_results(parser.retval, parser=parser)
+            resolved.append((submission, options, parser))
+
+        # only check the history once the results of the whole batch are in it
+        regressions = detect_regressions()
+
+        jobs = []
+        for submission, options, parser in resolved:
+            # the same log always updates the same job
+            job_guid = str(uuid.uuid5(uuid.NAMESPACE_URL, options['key_name']))
+            job = submission.create_job(job_guid, **options)
+            submission.complete_job(job, parser.retval, parser=parser, regressions=regressions)
+            jobs.append(job)
+
+        if jobs:
+            post_jobs(kwargs['treeherder_url'], kwargs['treeherder_client_id'],
+                      kwargs['treeherder_secret'], kwargs['repository'], jobs,
+                      concurrency=kwargs['concurrency'])
+
+        done.update(options['key_name'] for _, options, _ in batch
+                    if options['key_name'] not in unresolved)
+        save_checkpoint()
+
+        del batch[:]
+        return len(jobs)
+
+    try:
+        for key_name, parser, error in pool.imap_unordered(parse_backfill_log, items):
+            parsed += 1
+            if error:
+                print('Failed to parse %s, it will be retried by the next run: %s' % (
+                    key_name, error))
+                continue
+
+            submission, options = submissions[key_name]
+            options['key_name'] = key_name
+            batch.append((submission, options, parser))
+
+            if len(batch) >= settings['batch_size']:
+                submitted += submit_batch()
+                elapsed = time.time() - start
+                print('Backfill: %d parsed, %d submitted, %.1f logs/s' % (
+                    parsed, submitted, parsed / elapsed))
+
+        if batch:
+            submitted += submit_batch()
+    finally:
+        pool.terminate()
+
+    elapsed = time.time() - start
+    print('Backfill finished: %d parsed, %d submitted in %.1fs (%.1f logs/s)' % (
+        parsed, submitted, elapsed, parsed / elapsed if elapsed else 0))
+    if unresolved:
+        print('%d logs have revisions unknown to Treeherder, see %s' % (
+            len(unresolved), checkpoint))
+    if unsupported:
+        print('%d logs are not supported by the configuration, see %s' % (
+            len(unsupported), checkpoint))
+
+
+if __name__ == '__main__':
+    print('Raptor Treeherder Submission Script Version %s' % config['version'])
+    kwargs = parse_args()
+
+    # app-name required if test-type is coldlaunch
+    if kwargs['test_type'] == COLD_LAUNCH and not kwargs['manifest'] and kwargs['backfill'] is None:
+        if not kwargs['app_name']:
+            print('--app-name argument required when --test-type=cold-launch')
+            exit(1)
+
+    # Can only be imported after the environment has been activated
+    import mozinfo
+    import requests
+
+    from thclient import TreeherderClient, TreeherderJob, TreeherderJobCollection
+
+    from lib.s3 import S3Bucket
+    from lib.session import PooledSession
+
+    status = 0
+    if kwargs['flush_spool']:
+        status = flush_spool(kwargs)
+    elif kwargs['backfill'] is not None:
+        backfill(kwargs)
+    elif kwargs['manifest']:
+        submit_manifest(kwargs)
+    else:
+        submit_job(kwargs)
+
+    print('Treeherder requests: %d retries, %d throttled' % (get_throttle().retries,
+                                                             get_throttle().throttled))
+    sys.exit(status)